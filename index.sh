@@ -0,0 +1,9 @@
+#!/bin/sh
+
+# only to be run from docker, as the indexer service in docker-compose.prod.yml
+
+set -e
+
+# Ingest the dataset, then bring the doc index up to date with it (incrementally after the first run)
+PYTHONPATH=src FULLRUN=1 python -m bin.load_to_csv
+PYTHONPATH=src python -m bin.cache_docs
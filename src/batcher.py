@@ -0,0 +1,109 @@
+import asyncio
+import concurrent.futures
+import os
+import time
+
+from util import metrics
+
+# Max queries run through the projector and vector search together
+MAX_BATCH_SIZE = int(os.environ.get('SEARCH_BATCH_SIZE', '32'))
+# How long the first query in a batch waits for others to join it
+MAX_WAIT_MS = float(os.environ.get('SEARCH_BATCH_WAIT_MS', '5'))
+# Threads running batches, more than one only helps if torch isn't already using every core
+WORKERS = int(os.environ.get('SEARCH_WORKERS', '1'))
+
+class RequestBatcher:
+    """
+    Gathers concurrent requests on the event loop into batches, runs each batch with a blocking
+    batch function in a worker thread, then routes each result back to its caller.
+
+    A batch is run as soon as it reaches max_batch_size or max_wait_ms after its first request arrived. If a batch
+    fails, its requests are retried one at a time, so an error only reaches the request that caused it.
+    """
+    def __init__(self, batch_fn, max_batch_size: int = MAX_BATCH_SIZE, max_wait_ms: float = MAX_WAIT_MS, workers: int = WORKERS):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_ms / 1000
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batcher')
+        self.pending = []
+        self.timer = None
+        # The event loop only holds weak references to tasks, keep running batches alive until they finish
+        self.tasks = set()
+
+    async def submit(self, item, trace: list = None):
+        """Queue item for the next batch and wait for its result. If trace is given, the batch's stage timings are added to it."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((item, future, trace, time.perf_counter()))
+
+        if len(self.pending) >= self.max_batch_size:
+            self._flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_wait_seconds, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def _execute(self, batch: list, record_wait: bool = True):
+        # Runs on the worker thread, so waiting includes time spent queued behind earlier batches
+        if record_wait:
+            started_at = time.perf_counter()
+            for _, _, trace, queued_at in batch:
+                metrics.observe('batcher.queue_wait', started_at - queued_at)
+                if trace is not None:
+                    trace.append(('batcher.queue_wait', started_at - queued_at))
+        return metrics.traced(self.batch_fn, [item for item, _, _, _ in batch])
+
+    async def _run(self, batch: list, record_wait: bool = True):
+        loop = asyncio.get_running_loop()
+        try:
+            results, batch_trace = await loop.run_in_executor(self.executor, self._execute, batch, record_wait)
+        except Exception as e:
+            if len(batch) > 1:
+                # One bad item shouldn't fail every other request in the batch, rerun them one at a time so each gets its
+                # own result or error. Their queue wait was already recorded with the failed batch
+                await asyncio.gather(*(self._run([entry], record_wait=False) for entry in batch))
+                return
+            for _, future, _, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future, trace, _), result in zip(batch, results):
+            if trace is not None:
+                trace.extend(batch_trace)
+            # Caller may have gone away (eg. client disconnected) while the batch was running
+            if not future.done():
+                future.set_result(result)
+
+    async def run_batch(self, items: list, *args) -> list:
+        """
+        Run a batch the caller already gathered on the worker threads straight away, without waiting for others to join it.
+
+        If the batch fails, its items are retried one at a time, and the result of any item which still fails is its exception.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.executor, self.batch_fn, items, *args)
+        except Exception as e:
+            if len(items) == 1:
+                return [e]
+
+        async def run_one(item):
+            try:
+                return (await loop.run_in_executor(self.executor, self.batch_fn, [item], *args))[0]
+            except Exception as e:
+                return e
+
+        return await asyncio.gather(*(run_one(item) for item in items))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
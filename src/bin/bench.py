@@ -0,0 +1,359 @@
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import torch
+
+# Benchmarks use random word vectors and an in-process index, so they run anywhere without downloads or chroma
+os.environ.setdefault('QUICKVECS', '1')
+os.environ.setdefault('VECTOR_INDEX', 'local')
+
+from util import constants, devices, doc_store, columnar, distributed
+from util.metrics import get_percentiles
+from indexes import backends
+import models
+import models.query_projector, models.doc_projector, models.vectors
+import dataset
+import inference
+import encoder_pool
+import bin.train as train
+import bin.cache_docs as cache_docs
+
+SEED = 16
+
+NUM_DOCS = int(os.environ.get('BENCH_DOCS', '2000'))
+NUM_QUERIES = int(os.environ.get('BENCH_QUERIES', '500'))
+NUM_TRAIN_STEPS = int(os.environ.get('BENCH_TRAIN_STEPS', '20'))
+OUTPUT_PATH = os.environ.get('BENCH_OUTPUT', os.path.join(constants.DATA_PATH, 'bench.generated.json'))
+BASELINE_PATH = os.environ.get('BENCH_BASELINE', None)
+# Relative change in the wrong direction that counts as a regression when comparing against a baseline
+TOLERANCE = float(os.environ.get('BENCH_TOLERANCE', '0.1'))
+
+INDEX_NAME = 'bench-docs'
+
+# Training steps left out of the steps per second timing, and steps the final loss is averaged over
+TRAIN_WARMUP_STEPS = 2
+TRAIN_LOSS_STEPS = 5
+
+# Options compared against the plain float32 eager training step, with the same weights and batches
+TRAIN_OPTIONS = {
+    'fp32': {},
+    'bf16': {'bf16': True},
+    'compiled': {'compile': True},
+    'accumulate_4': {'grad_accumulation': 4}
+}
+
+# Data parallel training process counts compared, each against training in a single process
+TRAIN_PROCESS_COUNTS = [count for count in (int(value) for value in os.environ.get('BENCH_TRAIN_PROCESSES', '1,2,4').split(',')) if count <= (os.cpu_count() or 1)]
+
+# Mix of words in and out of the quick vecs vocab, so both known tokens and <UNK> get exercised
+WORDS = ['the', 'a', 'cat', 'dog', 'runs', 'fast', 'blue', 'sky', 'is', 'what', 'how', 'tall', 'tree', 'river', 'city', 'year']
+
+def seed_everything():
+    random.seed(SEED)
+    np.random.seed(SEED)
+    torch.manual_seed(SEED)
+
+def make_text(rng: np.random.Generator, min_words: int, max_words: int) -> str:
+    return ' '.join(rng.choice(WORDS, size=rng.integers(min_words, max_words + 1)))
+
+def make_corpus(num_docs: int, num_queries: int) -> tuple:
+    rng = np.random.default_rng(SEED)
+    docs = pd.DataFrame({
+        'doc_ref': [f"https://bench.example/{i}" for i in range(num_docs)],
+        'doc_text': [make_text(rng, 20, 120) for _ in range(num_docs)]
+    })
+    training_data = pd.DataFrame({
+        'query': [make_text(rng, 2, 10) for _ in range(num_docs)],
+        'doc_ref': docs['doc_ref'],
+        'doc_text': docs['doc_text'],
+        'is_selected': 1
+    })
+    # Unique queries, so the search benchmark measures the uncached path
+    queries = [f"{make_text(rng, 2, 10)} {i}" for i in range(num_queries)]
+    return docs, training_data, queries
+
+def bench_encoding(doc_projector: models.doc_projector.Model, docs: pd.DataFrame) -> tuple:
+    start = time.perf_counter()
+    encodings = inference.get_doc_encodings(doc_projector, docs['doc_text'].tolist())
+    elapsed = time.perf_counter() - start
+    return encodings, {'encoding.docs_per_sec': len(docs) / elapsed}
+
+def bench_pool_encoding(doc_projector: models.doc_projector.Model, docs: pd.DataFrame) -> dict:
+    doc_texts = docs['doc_text'].tolist()
+    batch_size = max(1, min(cache_docs.BATCH_SIZE, len(doc_texts) // (encoder_pool.WORKERS * encoder_pool.IN_FLIGHT_PER_WORKER)))
+    batches = [doc_texts[start:start + batch_size] for start in range(0, len(doc_texts), batch_size)]
+
+    with encoder_pool.EncoderPool(doc_projector.state_dict()) as pool:
+        # Start every worker before timing, so process start up isn't counted
+        list(pool.map([doc_texts[:1]] * encoder_pool.WORKERS))
+        start = time.perf_counter()
+        for _ in pool.map(batches):
+            pass
+        elapsed = time.perf_counter() - start
+
+    return {'encoding.pool_docs_per_sec': len(doc_texts) / elapsed}
+
+def bench_search(queries: list) -> dict:
+    inference.results_cache.clear()
+    inference.query_vector_cache.clear()
+
+    timings = []
+    start = time.perf_counter()
+    for query in queries:
+        query_start = time.perf_counter()
+        inference.search(query)
+        timings.append(time.perf_counter() - query_start)
+    elapsed = time.perf_counter() - start
+
+    metrics = {f"search.{name}": value for name, value in get_percentiles(timings).items()}
+    metrics['search.qps'] = len(queries) / elapsed
+
+    # Same queries again, now served from the results cache
+    start = time.perf_counter()
+    for query in queries:
+        inference.search(query)
+    metrics['search.cached_qps'] = len(queries) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    inference.results_cache.clear()
+    inference.query_vector_cache.clear()
+    inference.search_batch(queries)
+    metrics['search.batch_qps'] = len(queries) / (time.perf_counter() - start)
+
+    return metrics
+
+def bench_chunk_prep(training_data: pd.DataFrame) -> dict:
+    two_tower_dataset = dataset.TwoTowerDataset(training_data)
+    start = time.perf_counter()
+    # Mini mode skips the chunk cache, so this always measures preparation rather than a cache hit
+    two_tower_dataset[0]
+    elapsed = time.perf_counter() - start
+    return {'chunk_prep.rows_per_sec': min(len(training_data), dataset.CHUNK_SIZE) / elapsed}
+
+def get_training_batches(training_data: pd.DataFrame, device: torch.device) -> tuple:
+    loader = dataset.get_loader(dataset.TwoTowerDataset(training_data), train.BATCH_SIZE, shuffle=True)
+
+    batches = []
+    start = time.perf_counter()
+    for batch in loader:
+        batches.append(dataset.batch_to_device(batch, device))
+        if len(batches) == NUM_TRAIN_STEPS:
+            break
+    loader_elapsed = time.perf_counter() - start
+
+    return batches, {'loader.batches_per_sec': len(batches) / loader_elapsed}
+
+def bench_training(batches: list, device: torch.device, bf16: bool = False, compile: bool = False, grad_accumulation: int = 1) -> dict:
+    """Steps per second and the mean loss over the last few steps, from the same initial weights and batches for every option."""
+    torch.manual_seed(SEED)
+    query_projector = models.query_projector.Model().to(device)
+    doc_projector = models.doc_projector.Model().to(device)
+    # Averages gradients with the other processes when run by bench_training_processes
+    query_forward = train.compile_projector(distributed.wrap(query_projector), compile)
+    doc_forward = train.compile_projector(distributed.wrap(doc_projector), compile)
+    calc_loss = train.get_loss_function(device)
+    optimizer = torch.optim.AdamW(list(query_projector.parameters()) + list(doc_projector.parameters()), lr=train.LEARNING_RATE)
+
+    query_projector.train()
+    doc_projector.train()
+    losses = []
+    warmup_steps = min(TRAIN_WARMUP_STEPS, NUM_TRAIN_STEPS - 1)
+    optimizer.zero_grad()
+    for step in range(NUM_TRAIN_STEPS):
+        # Leave compilation and other first step costs out of the timing
+        if step == warmup_steps:
+            start = time.perf_counter()
+        losses.append(train.backward_step(query_forward, doc_forward, calc_loss, batches[step % len(batches)], device, bf16, grad_accumulation))
+        if (step + 1) % grad_accumulation == 0:
+            optimizer.step()
+            optimizer.zero_grad()
+    elapsed = time.perf_counter() - start
+
+    return {'steps_per_sec': (NUM_TRAIN_STEPS - warmup_steps) / elapsed, 'final_loss': float(np.mean(losses[-TRAIN_LOSS_STEPS:]))}
+
+def bench_training_options(training_data: pd.DataFrame) -> dict:
+    device = devices.get_device()
+    batches, metrics = get_training_batches(training_data, device)
+
+    for option, kwargs in TRAIN_OPTIONS.items():
+        print(f"Benchmarking training steps ({option})...")
+        try:
+            option_metrics = bench_training(batches, device, **kwargs)
+        except Exception as e:
+            # eg. torch.compile without a working compiler toolchain
+            print(f"WARNING: Skipping training option {option}: {e}")
+            continue
+        prefix = 'train' if option == 'fp32' else f"train.{option}"
+        metrics.update({f"{prefix}.{name}": value for name, value in option_metrics.items()})
+
+    return metrics
+
+def training_process(training_data: pd.DataFrame, result_path: str):
+    """One process of a data parallel training benchmark, rank 0 writes the steps per second to result_path."""
+    device = torch.device('cpu')
+    loader = dataset.get_loader(dataset.TwoTowerDataset(training_data), train.BATCH_SIZE, shuffle=True, rank=distributed.get_rank(), world_size=distributed.get_world_size())
+    if len(loader) == 0:
+        raise ValueError("Too few training rows for a batch per process, increase BENCH_DOCS")
+
+    # Prepared ahead of time like the single process benchmark, looping over epochs when there are too few batches
+    batches = []
+    epoch = 0
+    while len(batches) < NUM_TRAIN_STEPS:
+        dataset.set_loader_epoch(loader, epoch)
+        epoch += 1
+        batches.extend(dataset.batch_to_device(batch, device) for batch in loader)
+    training_metrics = bench_training(batches[:NUM_TRAIN_STEPS], device)
+
+    if distributed.is_main():
+        with open(result_path, 'w') as f:
+            json.dump(training_metrics, f)
+
+def bench_training_processes(training_data: pd.DataFrame) -> dict:
+    """Samples per second training data parallel in each of TRAIN_PROCESS_COUNTS processes, and the speedup over one process."""
+    metrics = {}
+    work_dir = tempfile.mkdtemp(prefix='bench-ddp-')
+    try:
+        for processes in TRAIN_PROCESS_COUNTS:
+            print(f"Benchmarking data parallel training ({processes} processes)...")
+            result_path = os.path.join(work_dir, f"{processes}.json")
+            distributed.launch(training_process, processes, (training_data, result_path))
+            with open(result_path) as f:
+                steps_per_sec = json.load(f)['steps_per_sec']
+            # Every process trains on its own batch per step
+            metrics[f"train.processes_{processes}.samples_per_sec"] = steps_per_sec * train.BATCH_SIZE * processes
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if 'train.processes_1.samples_per_sec' in metrics:
+        for processes in TRAIN_PROCESS_COUNTS:
+            metrics[f"train.processes_{processes}.speedup"] = metrics[f"train.processes_{processes}.samples_per_sec"] / metrics['train.processes_1.samples_per_sec']
+
+    return metrics
+
+def print_training_scaling(metrics: dict):
+    print(f"\n{'train processes':<20}{'samples/sec':>12}{'speedup':>10}{'efficiency':>12}")
+    for processes in TRAIN_PROCESS_COUNTS:
+        speedup = metrics.get(f"train.processes_{processes}.speedup")
+        if speedup is None:
+            continue
+        print(f"{processes:<20}{metrics[f'train.processes_{processes}.samples_per_sec']:>12.1f}{speedup:>10.2f}{speedup / processes:>12.1%}")
+
+def print_training_parity(metrics: dict):
+    baseline_loss = metrics.get('train.final_loss')
+    print(f"\n{'training option':<20}{'steps/sec':>12}{'final loss':>12}{'vs fp32':>10}")
+    for option in TRAIN_OPTIONS:
+        prefix = 'train' if option == 'fp32' else f"train.{option}"
+        if f"{prefix}.steps_per_sec" not in metrics:
+            continue
+        loss = metrics[f"{prefix}.final_loss"]
+        change = (loss - baseline_loss) / baseline_loss if baseline_loss else 0.0
+        print(f"{option:<20}{metrics[f'{prefix}.steps_per_sec']:>12.2f}{loss:>12.4f}{change:>+10.1%}")
+
+def compare_to_baseline(metrics: dict, baseline: dict) -> list:
+    """Print the change in every metric since the baseline, returning the names of metrics which regressed."""
+    regressions = []
+    print(f"\n{'metric':<30}{'baseline':>14}{'current':>14}{'change':>10}")
+    for name, value in metrics.items():
+        if name not in baseline or name.endswith('loss'):
+            continue
+        baseline_value = baseline[name]
+        change = (value - baseline_value) / baseline_value if baseline_value else 0.0
+        # Latencies should go down, everything else (throughputs) should go up
+        regressed = change > TOLERANCE if name.endswith('_ms') else change < -TOLERANCE
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<30}{baseline_value:>14.3f}{value:>14.3f}{change:>+10.1%}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+def main():
+    seed_everything()
+
+    config = {
+        'docs': NUM_DOCS,
+        'queries': NUM_QUERIES,
+        'train_steps': NUM_TRAIN_STEPS,
+        'seed': SEED,
+        'torch_threads': torch.get_num_threads(),
+        'encode_workers': encoder_pool.WORKERS,
+        'train_processes': TRAIN_PROCESS_COUNTS,
+        'device': devices.get_device().type
+    }
+    print(f"INFO: Benchmarking with {config}")
+
+    docs, training_data, queries = make_corpus(NUM_DOCS, NUM_QUERIES)
+
+    work_dir = tempfile.mkdtemp(prefix='bench-')
+    try:
+        docs_path = os.path.join(work_dir, 'docs.parquet')
+        columnar.write(docs, docs_path)
+
+        models.vectors.get_vecs()
+
+        doc_projector = models.doc_projector.Model()
+        doc_projector.eval()
+
+        metrics = {}
+
+        print('Benchmarking doc encoding...')
+        encodings, encoding_metrics = bench_encoding(doc_projector, docs)
+        metrics.update(encoding_metrics)
+
+        if encoder_pool.WORKERS > 1:
+            print(f"Benchmarking doc encoding with {encoder_pool.WORKERS} encoder processes...")
+            metrics.update(bench_pool_encoding(doc_projector, docs))
+
+        doc_index = backends.create_index(INDEX_NAME)
+        doc_index.add(docs['doc_ref'].tolist(), encodings)
+
+        # Point inference at the synthetic corpus instead of the real one
+        query_projector = models.query_projector.Model()
+        query_projector.eval()
+        inference.check_index_version()
+        inference.query_projector = query_projector
+        inference.docs = doc_store.load(docs_path, os.path.join(work_dir, 'doc-store'))
+        inference.doc_index = doc_index
+
+        print('Benchmarking search...')
+        metrics.update(bench_search(queries))
+
+        print('Benchmarking chunk preparation...')
+        metrics.update(bench_chunk_prep(training_data))
+
+        metrics.update(bench_training_options(training_data))
+
+        if devices.get_device().type == 'cpu':
+            metrics.update(bench_training_processes(training_data))
+    finally:
+        backends.delete_index(INDEX_NAME)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {'config': config, 'metrics': metrics}
+
+    for name, value in metrics.items():
+        print(f"{name}: {round(value, 3)}")
+
+    print_training_parity(metrics)
+    print_training_scaling(metrics)
+
+    with open(OUTPUT_PATH, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {OUTPUT_PATH}")
+
+    if BASELINE_PATH:
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != config:
+            print(f"WARNING: Baseline was recorded with a different config: {baseline.get('config')}")
+        regressions = compare_to_baseline(metrics, baseline['metrics'])
+        if regressions:
+            print(f"\n{len(regressions)} metrics regressed by more than {TOLERANCE:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
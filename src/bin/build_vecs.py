@@ -0,0 +1,32 @@
+import os
+import nltk
+import pandas as pd
+import tqdm
+
+from util import constants, columnar
+import models
+import models.vectors
+
+# Keep only the word vectors for tokens that appear in the training data
+TRIM_VECS = int(os.environ.get('TRIM_VECS', '0')) == 1
+
+nltk.download('punkt_tab')
+
+def get_corpus_tokens() -> set:
+    tokens = set()
+    for chunk in tqdm.tqdm(columnar.iter_chunks(constants.TRAINING_DATA_PATH, ['query', 'doc_text']), desc="Collecting corpus tokens"):
+        for text in pd.concat([chunk['query'], chunk['doc_text']]).drop_duplicates():
+            tokens.update(nltk.word_tokenize(str(text)))
+    return tokens
+
+def main():
+    keep_tokens = None
+    if TRIM_VECS:
+        print('INFO: Trimming word vectors to tokens used in the training data')
+        keep_tokens = get_corpus_tokens()
+        print(f"INFO: Found {len(keep_tokens)} distinct tokens")
+
+    models.vectors.build(keep_tokens=keep_tokens)
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,191 @@
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
 import pandas as pd
-import torch
-import numpy as np
-import swifter
+import tqdm
 
-from util import artifacts, constants, chroma, devices
+from util import artifacts, atomic, constants, devices, index_journal, metrics, columnar
+from indexes import backends, local_index
 import models
-import models.doc_embedder, models.doc_projector, models.vectors
+import models.doc_embedder, models.doc_projector, models.vectors, models.quantization
 import inference
+import encoder_pool
 
 device = devices.get_device()
 
-def main():
-    torch.no_grad()
+INDEX_NAME = 'docs'
+
+BATCH_SIZE = 1000
+
+# Drop the index and journal and encode every doc again, rather than resuming
+REBUILD_INDEX = int(os.environ.get('REBUILD_INDEX', '0')) == 1
+
+# Encoded batches waiting to be written to the index, encoding pauses while this many are queued
+WRITE_QUEUE_SIZE = 4
+
+class IndexWriter:
+    """
+    Writes encoded batches to the index and journal on a background thread, so encoding carries on during writes.
+
+    put blocks while WRITE_QUEUE_SIZE batches are waiting. An error on the writer thread is raised from the next
+    put, or from close unless raise_error is False.
+    """
+    def __init__(self, doc_index, journal: index_journal.IndexJournal):
+        self.doc_index = doc_index
+        self.journal = journal
+        self.queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='index-writer', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                # Keep draining so put never blocks forever, but write nothing after a failure
+                continue
+            doc_refs, doc_hashes, doc_encodings = item
+            try:
+                with metrics.timed('index.write'):
+                    self.doc_index.add(doc_refs, doc_encodings)
+                # Checkpoint, an interrupted run picks up from here
+                self.journal.record_added(doc_refs, doc_hashes)
+            except Exception as e:
+                self.error = e
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, doc_refs: list, doc_hashes: list, doc_encodings: list):
+        self._raise_error()
+        self.queue.put((doc_refs, doc_hashes, doc_encodings))
+
+    def close(self, raise_error: bool = True):
+        self.queue.put(None)
+        self.thread.join()
+        if raise_error:
+            self._raise_error()
+
+def get_model_fingerprint(state_dict: dict) -> str:
+    # Vectors are only reusable if they came from the same weights, vocab and quantization settings
+    digest = hashlib.blake2b(digest_size=8)
+    for key in sorted(state_dict):
+        digest.update(key.encode('utf-8'))
+        digest.update(state_dict[key].cpu().numpy().tobytes())
+    digest.update(models.vectors.get_vecs().fingerprint().encode('utf-8'))
+    quantized = models.quantization.QUANTIZE and device.type == 'cpu'
+    vector_dtype = local_index.VECTOR_DTYPE if backends.BACKEND == 'local' else local_index.FLOAT32
+    if quantized or vector_dtype != local_index.FLOAT32:
+        digest.update(f"quantized={quantized},vector_dtype={vector_dtype}".encode('utf-8'))
+    return digest.hexdigest()
+
+def load_state() -> dict:
+    try:
+        with open(constants.INDEXING_STATE_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_state(state: dict):
+    with atomic.writing(constants.INDEXING_STATE_PATH) as tmp_path, open(tmp_path, 'w') as f:
+        json.dump(state, f)
+
+def encode_batches(doc_projector: models.doc_projector.Model, doc_state_dict: dict, batches):
+    """Encode each batch of doc texts, across a pool of processes when running on the cpu with more than one encode worker."""
+    if device.type != 'cpu' or encoder_pool.WORKERS <= 1:
+        for batch in batches:
+            yield inference.get_doc_encodings(doc_projector, batch)
+        return
+
+    with encoder_pool.EncoderPool(doc_state_dict, models.quantization.QUANTIZE) as pool:
+        yield from pool.map(batches)
+
+def sync_index(doc_index, journal: index_journal.IndexJournal, doc_projector: models.doc_projector.Model, doc_state_dict: dict, data: pd.DataFrame):
+    """Bring doc_index in line with data, only encoding docs which are new or changed since the journal was written."""
+    current_doc_refs = set(data['doc_ref'])
+    removed_doc_refs = [doc_ref for doc_ref in journal.hashes if doc_ref not in current_doc_refs]
+    if removed_doc_refs:
+        print(f"Removing {len(removed_doc_refs)} documents...")
+        doc_index.delete(removed_doc_refs)
+        journal.record_deleted(removed_doc_refs)
+
+    pending = data[[journal.hashes.get(doc_ref) != doc_hash for doc_ref, doc_hash in zip(data['doc_ref'], data['doc_hash'])]]
+
+    print(f"Encoding {len(pending)} new or changed documents ({len(data) - len(pending)} up to date)...")
+
+    batches = [pending[start:start + BATCH_SIZE] for start in range(0, len(pending), BATCH_SIZE)]
+    doc_encodings = encode_batches(doc_projector, doc_state_dict, (batch['doc_text'].tolist() for batch in batches))
+
+    writer = IndexWriter(doc_index, journal)
+    try:
+        for batch, batch_encodings in tqdm.tqdm(zip(batches, doc_encodings), total=len(batches), desc="Encoding batches"):
+            writer.put(batch['doc_ref'].tolist(), batch['doc_hash'].tolist(), batch_encodings)
+    except BaseException as e:
+        # Raise what stopped encoding (eg. an encoder failure or ctrl-c), chained to any writer error rather than replaced by it
+        writer.close(raise_error=False)
+        if writer.error is not None and writer.error is not e:
+            raise e from writer.error
+        raise
+    writer.close()
+
+def update_index(doc_projector: models.doc_projector.Model, doc_state_dict: dict, data: pd.DataFrame, journal: index_journal.IndexJournal):
+    print('Updating existing index...')
+
+    doc_index = backends.open_index(INDEX_NAME)
+
+    sync_index(doc_index, journal, doc_projector, doc_state_dict, data)
+
+    journal.compact()
+
+def rebuild_index(doc_projector: models.doc_projector.Model, doc_state_dict: dict, data: pd.DataFrame, model_fingerprint: str):
+    state = load_state()
+    shadow_name = state.get('shadow')
+    shadow_journal = index_journal.IndexJournal(shadow_name) if shadow_name else None
+
+    if shadow_name and backends.index_exists(shadow_name) and shadow_journal.model_fingerprint == model_fingerprint:
+        print(f"Resuming interrupted rebuild into {shadow_name}...")
+        shadow_index = backends.open_index(shadow_name)
+    else:
+        if shadow_name:
+            backends.delete_index(shadow_name)
+            index_journal.delete_journal(shadow_name)
+
+        # Built under another name while the current index keeps serving, then swapped in once complete
+        shadow_name = f"{INDEX_NAME}-shadow-{int(time.time())}"
+        print(f"Rebuilding index into {shadow_name}...")
+        shadow_index = backends.create_index(shadow_name)
+        shadow_journal = index_journal.IndexJournal(shadow_name)
+        shadow_journal.start(model_fingerprint)
+        save_state({'shadow': shadow_name})
+
+    sync_index(shadow_index, shadow_journal, doc_projector, doc_state_dict, data)
+
+    print('Swapping in rebuilt index...')
+
+    backends.swap_index(shadow_name, INDEX_NAME)
+    shadow_journal.compact()
+    shadow_journal.move_to(INDEX_NAME)
+    save_state({})
 
+def main():
     models.vectors.get_vecs()
 
     print('Loading data...')
 
-    data = pd.read_csv(constants.DOCS_PATH)
+    data = columnar.read(constants.DOCS_PATH, ['doc_ref', 'doc_text'])
 
     print('Removing duplicate documents...')
 
     data = data.drop_duplicates(subset=['doc_ref'])
 
+    data['doc_hash'] = [index_journal.hash_doc(doc_text) for doc_text in data['doc_text']]
+
     print('Loading doc projector...')
 
     doc_projector = models.doc_projector.Model().to(device)
@@ -31,31 +194,29 @@ def main():
 
     doc_projector.load_state_dict(doc_state_dict)
     doc_projector.eval()
+    doc_projector = models.quantization.maybe_quantize(doc_projector, device)
 
-    print('Deleting existing cache...')
-
-    collection = chroma.client.get_or_create_collection(name="docs")
-
-    chroma.client.delete_collection(name="docs")
+    model_fingerprint = get_model_fingerprint(doc_state_dict)
 
-    print('Encoding documents...')
+    journal = index_journal.IndexJournal(INDEX_NAME)
 
-    collection = chroma.client.create_collection(name="docs", metadata={"hnsw:space": "cosine"})
+    if REBUILD_INDEX:
+        print('INFO: Full rebuild requested')
+        rebuild_index(doc_projector, doc_state_dict, data, model_fingerprint)
+    elif not backends.index_exists(INDEX_NAME) or not journal.exists():
+        print('INFO: No existing index, building from scratch')
+        rebuild_index(doc_projector, doc_state_dict, data, model_fingerprint)
+    elif journal.model_fingerprint != model_fingerprint:
+        print('INFO: Doc projector weights or vocab changed since the index was built, rebuilding from scratch')
+        rebuild_index(doc_projector, doc_state_dict, data, model_fingerprint)
+    else:
+        update_index(doc_projector, doc_state_dict, data, journal)
 
-    BATCH_SIZE = 1000
-    num_of_batches = len(data) // BATCH_SIZE
-    batches = np.array_split(data, num_of_batches)
-    for index, batch in enumerate(batches):
-        batch = batch.swifter.progress_bar(enable=True, desc=f"Encoding batch {index} of {len(batches)}").apply(lambda row: pd.Series({
-            'doc_ref': row['doc_ref'],
-            'doc_embedding': inference.get_doc_encoding(doc_projector, row['doc_text'])
-        }), axis=1)
+    inference.mark_index_updated(model_fingerprint)
 
-        print('Storing encodings for batch...')
+    metrics.print_summary()
 
-        collection.add(
-            ids=batch['doc_ref'].tolist(),
-            embeddings=batch['doc_embedding'].tolist()
-        )
+    print('> Done')
 
-        print('> Done')
+if __name__ == "__main__":
+    main()
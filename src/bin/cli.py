@@ -1,21 +1,76 @@
+import argparse
+import json
+import os
+import sys
+
 import models
 import models.query_embedder, models.query_projector, models.vectors
 import inference
 
+# Queries run through the projector and vector search together in batch mode
+BATCH_SIZE = int(os.environ.get('CLI_BATCH_SIZE', '1024'))
+
+def interactive():
+    while True:
+        query = input("Enter a query (or blank to quit): ")
+
+        if not query:
+            print('Goodbye!')
+            return
+
+        results = inference.search(query)
+
+        for result in results:
+            print(f"- {result['doc_ref']}")
+
+def read_batches(lines, batch_size: int):
+    batch = []
+    for line in lines:
+        query = line.rstrip('\n')
+        if not query.strip():
+            continue
+        batch.append(query)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def run_batch(input_file, output_file, k: int, include_text: bool, batch_size: int = BATCH_SIZE):
+    """Search for every query in input_file (one per line), writing one JSON line of results per query to output_file."""
+    count = 0
+    for queries in read_batches(input_file, batch_size):
+        for query, results in zip(queries, inference.search_batch(queries, k)):
+            if not include_text:
+                results = [{'doc_ref': result['doc_ref']} for result in results]
+            output_file.write(json.dumps({'query': query, 'results': results}) + '\n')
+        output_file.flush()
+        count += len(queries)
+        print(f"Searched {count} queries", file=sys.stderr)
+
 def main():
-    models.vectors.get_vecs()
+    parser = argparse.ArgumentParser(description='Search from the command line, interactively or for a file of queries')
+    parser.add_argument('--batch', metavar='FILE', help="Read queries one per line from FILE ('-' for stdin) and write results as JSON lines")
+    parser.add_argument('--output', metavar='FILE', default='-', help="Where to write batch results ('-' for stdout, the default)")
+    parser.add_argument('-k', type=int, default=inference.MAX_RESULTS, help='Results per query')
+    parser.add_argument('--no-text', action='store_true', help='Only include doc refs in batch results')
+    args = parser.parse_args()
 
-    query = input("Enter a query (or blank to quit): ")
+    models.vectors.get_vecs()
 
-    if not query:
-        print('Goodbye!')
+    if args.batch is None:
+        interactive()
         return
 
-    results = inference.search(query)
-
-    for result in results:
-        print(f"- {result['doc_ref']}")
+    input_file = sys.stdin if args.batch == '-' else open(args.batch)
+    output_file = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        run_batch(input_file, output_file, args.k, not args.no_text)
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not sys.stdout:
+            output_file.close()
 
+if __name__ == "__main__":
     main()
-
-main()
@@ -0,0 +1,146 @@
+import json
+import os
+import time
+import numpy as np
+
+from util import constants, columnar
+from util.metrics import get_percentiles
+from indexes import local_index
+import inference
+
+SEED = 16
+
+# Distinct queries evaluated, and the most docs indexed (every evaluated query's relevant docs are always included)
+NUM_QUERIES = int(os.environ.get('EVAL_QUERIES', '2000'))
+MAX_DOCS = int(os.environ.get('EVAL_DOCS', '100000'))
+
+def parse_list(name: str, default: str, type=int) -> list:
+    return [type(value) for value in os.environ.get(name, default).split(',') if value]
+
+K_VALUES = sorted(set(parse_list('EVAL_K', f"1,{inference.MAX_RESULTS},10")))
+DTYPES = parse_list('EVAL_DTYPES', ','.join(local_index.VECTOR_DTYPES), str)
+HNSW_MS = parse_list('EVAL_HNSW_M', '8,16,32')
+HNSW_EFS = parse_list('EVAL_HNSW_EF', '16,32,64,128,256')
+
+OUTPUT_PATH = os.environ.get('EVAL_OUTPUT', os.path.join(constants.DATA_PATH, 'eval.generated.json'))
+
+INDEX_NAME = 'eval-docs'
+
+def load_eval_set() -> tuple:
+    """Sampled queries with the set of doc_refs labelled relevant to each, plus the docs to index."""
+    rng = np.random.default_rng(SEED)
+
+    training_data = columnar.read(constants.TRAINING_DATA_PATH, ['query', 'doc_ref'])
+    relevant_by_query = training_data.groupby('query')['doc_ref'].agg(set)
+    queries = relevant_by_query.index[rng.permutation(len(relevant_by_query))[:NUM_QUERIES]].tolist()
+    relevant = [relevant_by_query[query] for query in queries]
+
+    docs = columnar.read(constants.DOCS_PATH, ['doc_ref', 'doc_text']).drop_duplicates(subset=['doc_ref'])
+    is_relevant = docs['doc_ref'].isin(set().union(*relevant)).values
+    others = np.flatnonzero(~is_relevant)
+    others = others[rng.permutation(len(others))[:max(0, MAX_DOCS - int(is_relevant.sum()))]]
+    docs = docs.iloc[np.sort(np.concatenate([np.flatnonzero(is_relevant), others]))]
+
+    return queries, relevant, docs
+
+def score(results: list, relevant: list, exact: list) -> dict:
+    """Recall@k and MRR against the labelled relevant docs, and overlap@k with the exact search results."""
+    metrics = {}
+    for k in K_VALUES:
+        metrics[f"recall@{k}"] = float(np.mean([len(wanted & set(found[:k])) / len(wanted) for found, wanted in zip(results, relevant)]))
+        metrics[f"exact_overlap@{k}"] = float(np.mean([len(set(found[:k]) & set(expected[:k])) / max(1, len(expected[:k])) for found, expected in zip(results, exact)]))
+
+    reciprocal_ranks = []
+    for found, wanted in zip(results, relevant):
+        rank = next((i + 1 for i, doc_ref in enumerate(found) if doc_ref in wanted), None)
+        reciprocal_ranks.append(1 / rank if rank is not None else 0.0)
+    metrics[f"mrr@{max(K_VALUES)}"] = float(np.mean(reciprocal_ranks))
+
+    return metrics
+
+def time_queries(doc_index: local_index.LocalIndex, query_vectors: np.ndarray, k: int) -> tuple:
+    """Results for every query, queried one at a time as the server would, with latency percentiles and batch throughput."""
+    results = []
+    timings = []
+    for query_vector in query_vectors:
+        start = time.perf_counter()
+        results.extend(doc_index.query([query_vector], k))
+        timings.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    doc_index.query(query_vectors, k)
+    batch_qps = len(query_vectors) / (time.perf_counter() - start)
+
+    return results, {**get_percentiles(timings), 'batch_qps': batch_qps}
+
+def describe(config: dict) -> str:
+    if not config['ann']:
+        return f"exact {config['dtype']}"
+    return f"hnsw {config['dtype']} M={config['hnsw_m']} ef={config['hnsw_ef']}"
+
+def main():
+    queries, relevant, docs = load_eval_set()
+    k = max(K_VALUES)
+
+    print(f"INFO: Evaluating {len(queries)} queries against {len(docs)} docs, k={K_VALUES}")
+
+    query_projector, doc_projector = inference.load_trained_projectors()
+
+    print('Encoding docs...')
+    doc_refs = docs['doc_ref'].tolist()
+    doc_vectors = np.array(inference.get_doc_encodings(doc_projector, docs['doc_text'].tolist()), dtype=np.float32)
+
+    print('Encoding queries...')
+    query_vectors = []
+    for start in range(0, len(queries), inference.DOC_ENCODING_BATCH_SIZE):
+        # Bypasses the server's cache, which may hold vectors from other projectors and shouldn't fill up with eval queries
+        query_vectors.extend(inference.get_query_encodings(query_projector, queries[start:start + inference.DOC_ENCODING_BATCH_SIZE], use_cache=False))
+
+    # Queries with no tokens get no results from the server, so they can't be compared across configs either
+    encodable = [i for i, query_vector in enumerate(query_vectors) if query_vector is not None]
+    if len(encodable) < len(queries):
+        print(f"WARNING: Skipping {len(queries) - len(encodable)} queries with no tokens")
+    queries = [queries[i] for i in encodable]
+    relevant = [relevant[i] for i in encodable]
+    query_vectors = np.array([query_vectors[i] for i in encodable], dtype=np.float32)
+
+    reports = []
+    try:
+        print('Computing exact ground truth...')
+        # Exact search over the float32 vectors, the upper bound on recall for these projectors
+        local_index.create_index(INDEX_NAME, local_index.FLOAT32).add(doc_refs, doc_vectors)
+        exact = local_index.LocalIndex(local_index.get_index_path(INDEX_NAME), ann=False).query(query_vectors, k)
+        reports.append({'config': 'ground truth', **score(exact, relevant, exact)})
+
+        for dtype in DTYPES:
+            local_index.create_index(INDEX_NAME, dtype).add(doc_refs, doc_vectors)
+            path = local_index.get_index_path(INDEX_NAME)
+
+            configs = [({'dtype': dtype, 'ann': False}, local_index.LocalIndex(path, ann=False))]
+            for hnsw_m in HNSW_MS:
+                # One graph per M, ef is a query time setting so every ef value searches the same graph
+                doc_index = local_index.LocalIndex(path, ann=True, hnsw_m=hnsw_m)
+                configs.extend(({'dtype': dtype, 'ann': True, 'hnsw_m': hnsw_m, 'hnsw_ef': hnsw_ef}, doc_index) for hnsw_ef in HNSW_EFS)
+
+            for config, doc_index in configs:
+                print(f"Evaluating {describe(config)}...")
+                if config['ann']:
+                    doc_index.hnsw_ef = config['hnsw_ef']
+                    # Build the graph before timing
+                    doc_index.query(query_vectors[:1], k)
+                results, latency = time_queries(doc_index, query_vectors, k)
+                reports.append({'config': describe(config), **config, **score(results, relevant, exact), **latency})
+    finally:
+        local_index.delete_index(INDEX_NAME)
+
+    columns = [f"recall@{k}" for k in K_VALUES] + [f"mrr@{k}", f"exact_overlap@{k}", 'p50_ms', 'p99_ms', 'batch_qps']
+    print(f"\n{'config':<32}" + ''.join(f"{column:>18}" for column in columns))
+    for report in reports:
+        print(f"{report['config']:<32}" + ''.join(f"{report[column]:>18.3f}" if column in report else f"{'':>18}" for column in columns))
+
+    with open(OUTPUT_PATH, 'w') as f:
+        json.dump({'queries': len(queries), 'docs': len(docs), 'k': K_VALUES, 'reports': reports}, f, indent=2)
+    print(f"Results written to {OUTPUT_PATH}")
+
+if __name__ == "__main__":
+    main()
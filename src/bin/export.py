@@ -0,0 +1,34 @@
+import os
+import torch
+
+from util import artifacts, constants
+import models
+import models.query_projector, models.doc_projector, models.export
+
+PROJECTORS = {
+    'query': models.query_projector.Model,
+    'doc': models.doc_projector.Model
+}
+
+def export_projector(query_or_doc: str, state_dict: dict) -> str:
+    """Export a projector's weights as a graph next to the weights files, returning its path once it passes the parity check."""
+    projector = PROJECTORS[query_or_doc]()
+    projector.load_state_dict(state_dict)
+    projector.eval()
+
+    graph = models.export.export(projector)
+    max_difference = models.export.check_parity(projector, graph)
+    print(f"INFO: Exported {query_or_doc} projector graph matches the eager model (max difference {max_difference:.2e})")
+
+    graph_path = os.path.join(constants.DATA_PATH, f"{query_or_doc}-projector-graph.generated.pt")
+    torch.jit.save(graph, graph_path)
+    return graph_path
+
+def main():
+    for query_or_doc in PROJECTORS:
+        state_dict = artifacts.load_artifact(f"{query_or_doc}-projector-weights", 'model')
+        graph_path = export_projector(query_or_doc, state_dict)
+        print(f"Saved {query_or_doc} projector graph to {graph_path}")
+
+if __name__ == "__main__":
+    main()
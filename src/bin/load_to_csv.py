@@ -1,31 +1,70 @@
+import os
 import datasets as hf_datasets
+import numpy as np
 import pandas as pd
-import swifter
-
-from util import constants, mini
-import models
-import models.doc_embedder, models.query_embedder
-
-def _expand_passages(row) -> hf_datasets.Dataset:
-    queries = []
-    doc_refs = []
-    doc_texts = []
-    is_selecteds = []
-    for i, is_selected in enumerate(row['passages']['is_selected']):
-        queries.append(row['query'])
-        doc_refs.append(row['passages']['url'][i])
-        doc_texts.append(row['passages']['passage_text'][i])
-        is_selecteds.append(is_selected)
-
-    return pd.DataFrame({
-        'query': queries,
-        'doc_ref': doc_refs,
-        'doc_text': doc_texts,
-        'is_selected': is_selecteds
-    })
+import pyarrow as pa
+import pyarrow.compute as pc
+import tqdm
+
+from util import constants, mini, doc_store, columnar
+
+# MS MARCO rows (queries, each with ~10 passages) read from the dataset at a time, bounds peak memory
+INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', '10000'))
+
+MINI_ROWS = 1500
+
+SAMPLE_QUERY_COUNT = 1000
+
+# Also write the training data as csv, for looking through by hand
+EXPORT_CSV = int(os.environ.get('EXPORT_CSV', '0')) == 1
+
+TRAINING_DATA_SCHEMA = pa.schema([('query', pa.string()), ('doc_ref', pa.string()), ('doc_text', pa.string()), ('is_selected', pa.int32())])
+DOCS_SCHEMA = pa.schema([('doc_ref', pa.string()), ('doc_text', pa.string())])
+
+def expand_passages(batch: pa.Table) -> pd.DataFrame:
+    """Explode a batch of MS MARCO rows into one row per selected passage, using columnar list kernels rather than a loop per row."""
+    passages = batch.column('passages').combine_chunks()
+    is_selected = pc.list_flatten(passages.field('is_selected'))
+    selected = pc.equal(is_selected, 1)
+    parent_rows = pc.filter(pc.list_parent_indices(passages.field('is_selected')), selected)
+
+    return pa.table({
+        'query': pc.take(batch.column('query'), parent_rows),
+        'doc_ref': pc.filter(pc.list_flatten(passages.field('url')), selected),
+        'doc_text': pc.filter(pc.list_flatten(passages.field('passage_text')), selected),
+        'is_selected': pc.filter(is_selected, selected)
+    }).to_pandas()
+
+def iter_batches(splits: hf_datasets.DatasetDict, max_rows: int = None):
+    rows_read = 0
+    for split in splits.values():
+        # Arrow format hands back slices of the memory mapped dataset files without converting rows to python
+        for batch in split.with_format('arrow').iter(batch_size=INGEST_BATCH_SIZE):
+            if max_rows is not None:
+                batch = batch.slice(0, max_rows - rows_read)
+            rows_read += len(batch)
+            yield batch
+            if max_rows is not None and rows_read >= max_rows:
+                return
+
+class QuerySampler:
+    """Uniform sample of distinct queries from a stream, keeping the queries with the smallest random keys (bottom-k sampling)."""
+    def __init__(self, count: int, rng: np.random.Generator):
+        self.count = count
+        self.rng = rng
+        self.sample = pd.DataFrame({'query': pd.Series(dtype=object), 'key': pd.Series(dtype=np.float64)})
+
+    def add(self, queries: pd.Series):
+        candidates = pd.DataFrame({'query': queries.drop_duplicates().values})
+        candidates['key'] = self.rng.random(len(candidates))
+        merged = pd.concat([self.sample, candidates], ignore_index=True).drop_duplicates(subset=['query'])
+        self.sample = merged.nsmallest(self.count, 'key')
+
+    def queries(self) -> pd.DataFrame:
+        return self.sample[['query']]
 
 def main():
-    if mini.is_mini():
+    if mini.MINI:
         print("INFO: Running in mini mode")
     else:
         print("INFO: Running in full mode")
@@ -34,38 +73,45 @@ def main():
 
     splits = hf_datasets.load_dataset("microsoft/ms_marco", "v1.1")
 
-    all_data = []
-    for split in splits:
-        rows = splits[split].to_list()
-        all_data.extend(rows)
-        
-    marco = pd.DataFrame(all_data)
+    max_rows = None
+    if mini.MINI:
+        print(f"INFO: Running in mini mode, only using first {MINI_ROWS} rows...")
+        max_rows = MINI_ROWS
 
-    if mini.is_mini():
-        print('INFO: Running in mini mode, only using first 1500 rows...')
-        marco = marco[:1500]
+    training_data = columnar.Writer(constants.TRAINING_DATA_PATH, TRAINING_DATA_SCHEMA)
+    docs = columnar.Writer(constants.DOCS_PATH, DOCS_SCHEMA)
+    sample_queries = QuerySampler(SAMPLE_QUERY_COUNT, np.random.default_rng())
+    # Hashes of doc_refs already written, so only a hash per distinct doc is held rather than the docs themselves
+    seen_doc_hashes = set()
 
-    marco = pd.concat(marco.swifter.progress_bar(enable=True, desc="Expanding passages...").apply(_expand_passages, axis=1).tolist(), ignore_index=True)
+    total_rows = max_rows if max_rows is not None else sum(len(split) for split in splits.values())
+    with tqdm.tqdm(total=total_rows, desc="Expanding passages...") as progress:
+        for batch in iter_batches(splits, max_rows):
+            selected = expand_passages(batch)
 
-    marco = marco[marco['is_selected'] == 1]
+            training_data.append(selected)
 
-    print('Writing docs to file...')
+            batch_docs = selected[['doc_ref', 'doc_text']].drop_duplicates(subset=['doc_ref'])
+            doc_hashes = pd.util.hash_array(batch_docs['doc_ref'].values)
+            is_new = np.fromiter((doc_hash not in seen_doc_hashes for doc_hash in doc_hashes.tolist()), dtype=bool, count=len(doc_hashes))
+            seen_doc_hashes.update(doc_hashes[is_new].tolist())
+            docs.append(batch_docs[is_new])
 
-    docs = marco[['doc_ref', 'doc_text']]
+            sample_queries.add(selected['query'])
 
-    docs = docs.drop_duplicates(subset=['doc_ref'])
+            progress.update(len(batch))
 
-    docs.to_csv(constants.DOCS_PATH, index=False)
+    training_data.close()
+    docs.close()
 
-    sample_queries = marco[['query']]
+    doc_store.build()
 
-    sample_queries = sample_queries.drop_duplicates(subset=['query'])
+    columnar.write(sample_queries.queries(), constants.SAMPLE_QUERIES_PATH)
 
-    sample_queries = sample_queries.sample(1000)
-
-    sample_queries.to_csv(constants.SAMPLE_QUERIES_PATH, index=False)
-
-    marco.to_csv(constants.TRAINING_DATA_PATH, index=False)
+    if EXPORT_CSV:
+        print('Exporting csv copies...')
+        for path in [constants.TRAINING_DATA_PATH, constants.DOCS_PATH, constants.SAMPLE_QUERIES_PATH]:
+            columnar.export_csv(path, f"{os.path.splitext(path)[0]}.csv")
 
     print('Done!')
 
@@ -0,0 +1,98 @@
+import os
+import time
+import numpy as np
+import torch
+
+from util import constants, columnar
+from indexes import local_index
+import models
+import models.query_embedder, models.quantization
+import dataset
+import inference
+
+# Quantized projectors only run on the cpu, so every setting is measured there
+device = torch.device('cpu')
+
+# Docs and queries the report is run over, sampled from the loaded dataset
+NUM_DOCS = int(os.environ.get('QUANT_REPORT_DOCS', '5000'))
+NUM_QUERIES = int(os.environ.get('QUANT_REPORT_QUERIES', '500'))
+K = int(os.environ.get('QUANT_REPORT_K', '10'))
+
+SEED = 16
+
+INDEX_NAME = 'quant-report'
+
+def load_projectors() -> dict:
+    query_projector, doc_projector = inference.load_trained_projectors(device)
+
+    return {
+        'float32': (query_projector, doc_projector),
+        'int8': (models.quantization.quantize(query_projector), models.quantization.quantize(doc_projector))
+    }
+
+def encode(query_projector, doc_projector, queries: list, doc_texts: list) -> tuple:
+    start = time.perf_counter()
+    doc_vectors = np.array(inference.get_doc_encodings(doc_projector, doc_texts, device=device), dtype=np.float32)
+    doc_seconds = time.perf_counter() - start
+
+    # One query at a time, matching how queries arrive at the server
+    start = time.perf_counter()
+    with torch.inference_mode():
+        query_vectors = []
+        for query in queries:
+            padded_ids, lengths = dataset.pad_batch_ids([models.query_embedder.get_ids_for_query(query)], device)
+            query_vectors.append(query_projector(padded_ids, lengths)[0][0].tolist())
+    query_seconds = time.perf_counter() - start
+
+    return np.array(query_vectors, dtype=np.float32), doc_vectors, {'query_ms': 1000 * query_seconds / len(queries), 'docs_per_sec': len(doc_texts) / doc_seconds}
+
+def get_recall(results: list, expected: list) -> float:
+    return float(np.mean([len(set(found) & set(wanted)) / len(wanted) for found, wanted in zip(results, expected) if wanted]))
+
+def main():
+    rng = np.random.default_rng(SEED)
+
+    docs = columnar.read(constants.DOCS_PATH, ['doc_ref', 'doc_text'])
+    docs = docs.iloc[rng.permutation(len(docs))[:NUM_DOCS]]
+    queries = columnar.read(constants.SAMPLE_QUERIES_PATH, ['query'])['query'].tolist()[:NUM_QUERIES]
+    doc_refs = docs['doc_ref'].tolist()
+
+    print(f"INFO: Comparing quantization settings over {len(docs)} docs and {len(queries)} queries, recall@{K} against float32")
+
+    rows = []
+    expected = None
+    try:
+        for projector_dtype, (query_projector, doc_projector) in load_projectors().items():
+            print(f"Encoding with {projector_dtype} projectors...")
+            query_vectors, doc_vectors, encode_stats = encode(query_projector, doc_projector, queries, docs['doc_text'].tolist())
+
+            for vector_dtype in local_index.VECTOR_DTYPES:
+                doc_index = local_index.create_index(INDEX_NAME, vector_dtype)
+                doc_index.add(doc_refs, doc_vectors)
+
+                start = time.perf_counter()
+                results = doc_index.query(query_vectors, K)
+                search_ms = 1000 * (time.perf_counter() - start) / len(queries)
+
+                # Float32 everything is the reference the other settings are measured against
+                if expected is None:
+                    expected = results
+
+                vector_bytes = os.path.getsize(os.path.join(doc_index.path, doc_index.vectors_file)) + os.path.getsize(os.path.join(doc_index.path, 'scales.f32'))
+                rows.append({
+                    'projectors': projector_dtype,
+                    'vectors': vector_dtype,
+                    'recall': get_recall(results, expected),
+                    'bytes_per_doc': vector_bytes / len(doc_refs),
+                    'search_ms': search_ms,
+                    **encode_stats
+                })
+    finally:
+        local_index.delete_index(INDEX_NAME)
+
+    print(f"\n{'projectors':<12}{'vectors':<10}{f'recall@{K}':>10}{'bytes/doc':>11}{'query ms':>10}{'docs/sec':>10}{'search ms':>11}")
+    for row in rows:
+        print(f"{row['projectors']:<12}{row['vectors']:<10}{row['recall']:>10.3f}{row['bytes_per_doc']:>11.0f}{row['query_ms']:>10.3f}{row['docs_per_sec']:>10.0f}{row['search_ms']:>11.3f}")
+
+if __name__ == "__main__":
+    main()
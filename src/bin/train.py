@@ -1,6 +1,5 @@
 import os
 from pathlib import Path
-import pandas as pd
 import torch
 import tqdm
 from typing import TypedDict
@@ -10,34 +9,100 @@ import wandb
 import models
 import models.doc_projector, models.query_projector, models.doc_embedder, models.query_embedder, models.vectors
 import dataset
-from util import devices, artifacts, constants
+import negatives
+import bin.export
+from util import devices, artifacts, constants, columnar, checkpoints, distributed
 
 EPOCHS = 100
 LEARNING_RATE = 0.001
 MARGIN = 0.15
-BATCH_SIZE = 64
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', '64'))
+# Batches whose gradients are summed before each optimizer step, for an effective batch of BATCH_SIZE * GRAD_ACCUMULATION
+GRAD_ACCUMULATION = int(os.environ.get('GRAD_ACCUMULATION', '1'))
+# Run forward passes under bfloat16 autocast, mostly useful on cpus with native bfloat16 support
+BF16 = int(os.environ.get('BF16', '0')) == 1
+# Run the projectors through torch.compile
+COMPILE = int(os.environ.get('COMPILE', '0')) == 1
 EARLY_STOP_AFTER = 7
+# 'sampled' (a random negative doc per row, prepared with the data) or 'in-batch' (other positives in the batch)
+NEGATIVE_SAMPLING = os.environ.get('NEGATIVES', negatives.SAMPLED)
 
 torch.manual_seed(16)
 
+def get_loss_function(device: torch.device):
+    return torch.nn.TripletMarginWithDistanceLoss(margin=MARGIN, distance_function=lambda query, doc: 1 - torch.nn.functional.cosine_similarity(query, doc)).to(device)
+
+def get_autocast(device: torch.device, bf16: bool = BF16):
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=bf16)
+
+def compile_projector(projector: torch.nn.Module, compile: bool = COMPILE) -> torch.nn.Module:
+    # The compiled wrapper shares the projector's parameters, keep using the projector itself for state dicts
+    return torch.compile(projector, dynamic=True) if compile else projector
+
+def get_batch_loss(query_projector: models.query_projector.Model, doc_projector: models.doc_projector.Model, calc_loss, batch: dict, negative_sampling: str = NEGATIVE_SAMPLING):
+    query_outputs, _ = query_projector(batch['query_ids'], batch['query_lengths'])
+    relevant_doc_outputs, _ = doc_projector(batch['relevant_doc_ids'], batch['relevant_doc_lengths'])
+
+    # Loss in float32 even when the projectors ran under autocast
+    query_outputs = query_outputs.float()
+    relevant_doc_outputs = relevant_doc_outputs.float()
+
+    if negative_sampling == negatives.IN_BATCH:
+        return negatives.in_batch_triplet_loss(query_outputs, relevant_doc_outputs, batch['query_groups'], batch['doc_groups'], MARGIN)
+
+    irrelevant_doc_outputs, _ = doc_projector(batch['irrelevant_doc_ids'], batch['irrelevant_doc_lengths'])
+
+    return calc_loss(query_outputs, relevant_doc_outputs, irrelevant_doc_outputs.float())
+
+def backward_step(query_projector, doc_projector, calc_loss, batch: dict, device: torch.device, bf16: bool = BF16, grad_accumulation: int = GRAD_ACCUMULATION) -> float:
+    """Forward and backward pass for one batch, adding its share of the gradient. Returns the batch loss."""
+    with get_autocast(device, bf16):
+        loss = get_batch_loss(query_projector, doc_projector, calc_loss, batch)
+
+    (loss / grad_accumulation).backward()
+
+    return loss.item()
+
 def main():
-    data = pd.read_csv(constants.TRAINING_DATA_PATH)
+    # Built once up front, rather than by every training process at the same time
+    models.vectors.get_vecs()
+
+    # TRAIN_PROCESSES > 1 trains data parallel across that many processes, each on a share of every epoch's batches
+    distributed.launch(run)
 
-    print(f"INFO: Running for {len(data)} training rows")
+def run():
+    data = columnar.read(constants.TRAINING_DATA_PATH, ['query', 'doc_ref', 'doc_text'])
 
-    wandb.init(project='search', name='search')
+    is_main = distributed.is_main()
+    world_size = distributed.get_world_size()
+
+    if is_main:
+        print(f"INFO: Running for {len(data)} training rows")
+
+    # Only rank 0 logs to wandb, keeping the others' runs out of the project
+    wandb.init(project='search', name='search', mode=None if is_main else 'disabled')
     wandb.config = {
         "training_data_size": len(data),
         "learning_rate": LEARNING_RATE,
         "query_hidden_layer_dimensions": models.query_projector.QUERY_HIDDEN_LAYER_DIMENSION,
         "doc_hidden_layer_dimensions": models.doc_projector.DOC_HIDDEN_LAYER_DIMENSION,
         "batch_size": BATCH_SIZE,
-        "epochs": EPOCHS
+        "grad_accumulation": GRAD_ACCUMULATION,
+        "bf16": BF16,
+        "compile": COMPILE,
+        "epochs": EPOCHS,
+        "negative_sampling": NEGATIVE_SAMPLING,
+        "length_bucketing": dataset.LENGTH_BUCKETING,
+        "loader_workers": dataset.LOADER_WORKERS,
+        "train_processes": world_size
     }
 
     device = devices.get_device()
 
-    print(f"INFO: Using device: {device.type}")
+    if is_main:
+        print(f"INFO: Using device: {device.type}")
+        print(f"INFO: Using {NEGATIVE_SAMPLING} negatives")
+        print(f"INFO: Effective batch size {BATCH_SIZE * GRAD_ACCUMULATION * world_size} ({world_size} processes x {GRAD_ACCUMULATION} x {BATCH_SIZE}), bf16 autocast {'on' if BF16 else 'off'}, compile {'on' if COMPILE else 'off'}")
     
     data = data.sample(frac=1, random_state=16).reset_index(drop=True)
 
@@ -48,13 +113,25 @@ def main():
     train.reset_index(drop=True, inplace=True)
     val.reset_index(drop=True, inplace=True)
 
-    train_loader = torch.utils.data.DataLoader(dataset.TwoTowerDataset(train), batch_size=BATCH_SIZE, shuffle=True, collate_fn=dataset.collate_two_tower_batch)
-    val_loader = torch.utils.data.DataLoader(dataset.TwoTowerDataset(val), batch_size=BATCH_SIZE, shuffle=False, collate_fn=dataset.collate_two_tower_batch)
+    # Rank 0 prepares and caches every chunk first, then the other processes open them from the chunk cache
+    if not is_main:
+        distributed.barrier()
+    train_loader = dataset.get_loader(dataset.TwoTowerDataset(train, NEGATIVE_SAMPLING), BATCH_SIZE, shuffle=True, rank=distributed.get_rank(), world_size=world_size)
+    val_loader = dataset.get_loader(dataset.TwoTowerDataset(val, NEGATIVE_SAMPLING), BATCH_SIZE, shuffle=False, rank=distributed.get_rank(), world_size=world_size)
+    if is_main:
+        distributed.barrier()
 
     query_projector = models.query_projector.Model().to(device)
     doc_projector = models.doc_projector.Model().to(device)
 
-    calc_loss = torch.nn.TripletMarginWithDistanceLoss(margin=MARGIN, distance_function=lambda query, doc: 1 - torch.nn.functional.cosine_similarity(query, doc)).to(device)
+    # Every process starts from rank 0's weights and averages its gradients with the others on backward
+    query_parallel = distributed.wrap(query_projector)
+    doc_parallel = distributed.wrap(doc_projector)
+
+    query_forward = compile_projector(query_parallel)
+    doc_forward = compile_projector(doc_parallel)
+
+    calc_loss = get_loss_function(device)
 
     all_params = list(query_projector.parameters()) + list(doc_projector.parameters())
     optimizer = torch.optim.AdamW(all_params, lr=LEARNING_RATE)
@@ -63,8 +140,8 @@ def main():
     best_val_loss = float('inf')
     best_query_state_dict = None
     best_doc_state_dict = None
-    
-    models.vectors.get_vecs()
+
+    checkpoint_writer = checkpoints.AsyncCheckpointWriter()
 
     def get_epoch_weight_path(epoch, query_or_doc):
         return os.path.join(constants.DATA_PATH, f"epoch-weights/{query_or_doc}-weights_epoch-{epoch + 1}.generated.pt")
@@ -74,60 +151,74 @@ def main():
         query_projector.train()
         doc_projector.train()
 
-        train_loss = 0.0
-        for batch in tqdm.tqdm(train_loader, desc=f"Epoch {epoch+1}", leave=False):
+        dataset.set_loader_epoch(train_loader, epoch)
 
-            optimizer.zero_grad()
+        train_loss = 0.0
+        optimizer.zero_grad()
+        for step, batch in enumerate(tqdm.tqdm(train_loader, desc=f"Epoch {epoch+1}", leave=False, disable=not is_main)):
 
-            query_outputs, _ = query_projector(batch['query_embeddings'], batch['query_embedding_lengths'])
-            relevant_doc_outputs, _ = doc_projector(batch['relevant_doc_embeddings'], batch['relevant_doc_embedding_lengths'])
-            irrelevant_doc_outputs, _ = doc_projector(batch['irrelevant_doc_embeddings'], batch['irrelevant_doc_embedding_lengths'])
+            batch = dataset.batch_to_device(batch, device)
 
-            loss = calc_loss(query_outputs, relevant_doc_outputs, irrelevant_doc_outputs)
+            is_step = (step + 1) % GRAD_ACCUMULATION == 0 or step + 1 == len(train_loader)
+            # The last group of an epoch can be short, average over the batches it actually has
+            group_size = min(GRAD_ACCUMULATION, len(train_loader) - step // GRAD_ACCUMULATION * GRAD_ACCUMULATION)
 
-            loss.backward()
-            optimizer.step()
+            # Gradients are only averaged across processes on the batch before each optimizer step
+            with distributed.no_sync(*([] if is_step else [query_parallel, doc_parallel])):
+                train_loss += backward_step(query_forward, doc_forward, calc_loss, batch, device, grad_accumulation=group_size)
 
-            train_loss += loss.item()
+            if is_step:
+                optimizer.step()
+                optimizer.zero_grad()
         
-        train_loss = train_loss / len(train_loader)
+        train_loss, train_batches = distributed.all_reduce_sum([train_loss, len(train_loader)])
+        train_loss = train_loss / train_batches
 
         query_projector.eval()
         doc_projector.eval()
         val_loss = 0.0
 
-        with torch.no_grad():
+        with torch.no_grad(), get_autocast(device):
             for batch in val_loader:
-                query_outputs, _ = query_projector(batch['query_embeddings'], batch['query_embedding_lengths'])
-                relevant_doc_outputs, _ = doc_projector(batch['relevant_doc_embeddings'], batch['relevant_doc_embedding_lengths'])
-                irrelevant_doc_outputs, _ = doc_projector(batch['irrelevant_doc_embeddings'], batch['irrelevant_doc_embedding_lengths'])
-
-                loss = calc_loss(query_outputs, relevant_doc_outputs, irrelevant_doc_outputs)
+                batch = dataset.batch_to_device(batch, device)
+                loss = get_batch_loss(query_forward, doc_forward, calc_loss, batch)
 
                 val_loss += loss.item()
                 
-        val_loss = val_loss / len(val_loader)
+        # Every process gets the same mean over all processes' batches, so they all make the same early stopping decision
+        val_loss, val_batches = distributed.all_reduce_sum([val_loss, len(val_loader)])
+        val_loss = val_loss / val_batches
 
-        print(f"Epoch {epoch + 1}, train loss: {round(train_loss, 6)}, val loss: {round(val_loss, 6)}")
+        if is_main:
+            print(f"Epoch {epoch + 1}, train loss: {round(train_loss, 6)}, val loss: {round(val_loss, 6)}")
 
         wandb.log({ 'epoch': epoch + 1, 'train-loss': train_loss, 'val_loss': val_loss })
 
         if val_loss < best_val_loss:
             best_val_loss = val_loss
-            best_query_state_dict = query_projector.state_dict()
-            best_doc_state_dict = doc_projector.state_dict()
+            # Copies, state_dict() alone would keep changing as training carries on
+            best_query_state_dict = checkpoints.snapshot(query_projector.state_dict())
+            best_doc_state_dict = checkpoints.snapshot(doc_projector.state_dict())
             val_loss_failed_to_improve_for_epochs = 0
 
-            Path(os.path.join(constants.DATA_PATH, "epoch-weights")).mkdir(exist_ok=True)
-            torch.save(best_query_state_dict, get_epoch_weight_path(epoch, 'query'))
-            torch.save(best_doc_state_dict, get_epoch_weight_path(epoch, 'doc'))
+            # Weights are the same in every process, only rank 0 writes them
+            if is_main:
+                Path(os.path.join(constants.DATA_PATH, "epoch-weights")).mkdir(exist_ok=True)
+                checkpoint_writer.save(best_query_state_dict, get_epoch_weight_path(epoch, 'query'))
+                checkpoint_writer.save(best_doc_state_dict, get_epoch_weight_path(epoch, 'doc'))
         else:
             val_loss_failed_to_improve_for_epochs += 1
 
         if val_loss_failed_to_improve_for_epochs == EARLY_STOP_AFTER:
-            print(f"Validation loss failed to improve for {EARLY_STOP_AFTER} epochs. Early stopping now.")
+            if is_main:
+                print(f"Validation loss failed to improve for {EARLY_STOP_AFTER} epochs. Early stopping now.")
             break
 
+    checkpoint_writer.close()
+
+    if not is_main:
+        return
+
     query_model_save_path = os.path.join(constants.DATA_PATH, 'query-projector-weights.generated.pt')
     torch.save(best_query_state_dict, query_model_save_path)
     artifacts.store_artifact('query-projector-weights', 'model', query_model_save_path)
@@ -136,4 +227,8 @@ def main():
     torch.save(best_doc_state_dict, doc_model_save_path)
     artifacts.store_artifact('doc-projector-weights', 'model', doc_model_save_path)
 
+    print('Exporting projector graphs for serving...')
+    artifacts.store_artifact('query-projector-graph', 'graph', bin.export.export_projector('query', best_query_state_dict))
+    artifacts.store_artifact('doc-projector-graph', 'graph', bin.export.export_projector('doc', best_doc_state_dict))
+
     wandb.finish()
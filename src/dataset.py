@@ -2,95 +2,349 @@ import torch
 import pandas as pd
 import numpy as np
 import swifter
-import joblib
+import hashlib
+from collections import OrderedDict
 from pathlib import Path
 import os
+from functools import partial
 
 import models
-import models.query_embedder, models.doc_embedder
-from util import devices, mini, constants
+import models.query_embedder, models.doc_embedder, models.vectors
+import negatives
+from util import atomic, devices, mini, constants, distributed
 
 CHUNK_SIZE = 10000
 
+# Max prepared chunks kept open per dataset, least recently used chunks are evicted past this
+MAX_RESIDENT_CHUNKS = int(os.environ.get('MAX_RESIDENT_CHUNKS', '4'))
+
+FIELDS = ['query_ids', 'relevant_doc_ids', 'irrelevant_doc_ids']
+
+# Group rows of similar doc length into the same training batches, so less of each batch is padding
+LENGTH_BUCKETING = int(os.environ.get('LENGTH_BUCKETING', '1')) == 1
+# Batches drawn from each shuffled pool of rows that is sorted by length, larger pools pad less but are less random
+BUCKET_BATCHES = int(os.environ.get('BUCKET_BATCHES', '50'))
+
+# Training data loader worker processes (per training process), mini runs are small enough that starting workers costs more than it saves
+LOADER_WORKERS = int(os.environ.get('LOADER_WORKERS', '0' if mini.MINI else str(min(4, max((os.cpu_count() or 1) // distributed.WORLD_SIZE - 1, 0)))))
+# Batches each loader worker prepares ahead of the training loop
+LOADER_PREFETCH = int(os.environ.get('LOADER_PREFETCH', '4'))
+
 device = devices.get_device()
 
+def pack_ids(values) -> tuple:
+    """Pack a sequence of token id lists into one flat int32 array plus an offsets array (len(values) + 1)."""
+    lengths = np.fromiter((len(ids) for ids in values), dtype=np.int64, count=len(values))
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    flat = np.fromiter((token_id for ids in values for token_id in ids), dtype=np.int32, count=offsets[-1])
+    return flat, offsets
+
+class PackedChunk:
+    """
+    A prepared chunk of rows, each field stored as flat token ids with an offsets index.
+
+    When loaded from the chunk cache the arrays are read only memory maps, so reading a row only
+    touches the pages it needs and evicting the chunk gives the memory back to the OS.
+    """
+    def __init__(self, arrays: dict):
+        self.arrays = arrays
+
+    def __len__(self):
+        return len(self.arrays[f"{FIELDS[0]}_offsets"]) - 1
+
+    def get_ids(self, field: str, idx: int) -> np.ndarray:
+        offsets = self.arrays[f"{field}_offsets"]
+        return self.arrays[field][offsets[idx]:offsets[idx + 1]]
+
+    def lengths(self, field: str) -> np.ndarray:
+        return np.diff(self.arrays[f"{field}_offsets"])
+
+    def save(self, path: str):
+        # If another process writes the same chunk first, theirs is kept
+        with atomic.writing(path, directory=True) as tmp_path:
+            for name, array in self.arrays.items():
+                np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+
+    @staticmethod
+    def load(path: str, fields: list = FIELDS):
+        if not os.path.isdir(path):
+            raise FileNotFoundError(path)
+        arrays = {}
+        for field in fields:
+            arrays[field] = np.load(os.path.join(path, f"{field}.npy"), mmap_mode='r')
+            arrays[f"{field}_offsets"] = np.load(os.path.join(path, f"{field}_offsets.npy"), mmap_mode='r')
+        return PackedChunk(arrays)
+
 class TwoTowerDataset(torch.utils.data.Dataset):
-    def __init__(self, data: pd.DataFrame):
+    def __init__(self, data: pd.DataFrame, negative_sampling: str = negatives.SAMPLED):
+        if negative_sampling not in negatives.MODES:
+            raise ValueError(f"Unknown negative sampling mode {negative_sampling}, expected one of {', '.join(negatives.MODES)}")
         self.data = data
-        self.prepped = {}
+        self.negative_sampling = negative_sampling
+        # In batch negatives come from the other rows at collate time, so chunks don't need a negative
+        self.fields = FIELDS if negative_sampling == negatives.SAMPLED else FIELDS[:2]
+        self.prepped = OrderedDict()
+        self.cache_dir = os.path.join(constants.DATA_PATH, 'chunks', self.__get_cache_key())
+
+        # Integer group per row, used to tell which rows share a query or a doc without comparing strings
+        self.query_groups = pd.factorize(data['query'])[0]
+        self.doc_groups = pd.factorize(data['doc_ref'])[0]
+        _, self.doc_group_first_rows = np.unique(self.doc_groups, return_index=True)
 
     def __len__(self):
         return len(self.data.index)
-    
-    def __get_irrelevant_doc_embedding(self, row):
-        for i in range(0, 100):
-            other_row = self.data.sample(1).iloc[0]
-            if (other_row['query'] != row['query']) and (other_row['doc_ref'] != row['doc_ref']):
-                return models.doc_embedder.get_embeddings_for_doc(other_row['doc_text'])
-        raise ValueError("No non-relevant result found in random 100 row sample. Weird.")
-
-    def __prepare_row(self, row):
-        return pd.Series({
-            'query_embeddings': models.query_embedder.get_embeddings_for_query(row['query']),
-            'relevant_doc_embeddings': models.doc_embedder.get_embeddings_for_doc(row['doc_text']),
-            'irrelevant_doc_embeddings': self.__get_irrelevant_doc_embedding(row)
-        })
-    
-    def __get_chunk(self, chunk_idx: int):
-        if chunk_idx not in self.prepped:
-            Path(os.path.join(constants.DATA_PATH, 'chunks')).mkdir(parents=True, exist_ok=True)
-            chunk_filepath = os.path.join(constants.DATA_PATH, f"chunks/chunk-{chunk_idx}.generated.pt")
-            try:
-                if mini.is_mini():
-                    raise FileNotFoundError('CACHE MISS: Mini mode, not loading')
-                chunk = joblib.load(chunk_filepath)
-                print('CACHE HIT: Got existing chunk from file...')
-                self.prepped[chunk_idx] = chunk
-                return chunk
-            except:
-                rows = self.data[chunk_idx * CHUNK_SIZE:(chunk_idx + 1) * CHUNK_SIZE]
-                chunk = rows.swifter.progress_bar(enable=True, desc=f"Preloading data chunk {chunk_idx}").apply(self.__prepare_row, axis=1)
-                self.prepped[chunk_idx] = chunk
-                if not mini.is_mini():
-                    joblib.dump(chunk, chunk_filepath)
-                print('> Done')
-        return self.prepped[chunk_idx]
-
-    def __getitem__(self, idx: int) -> dict[str, str]:
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if not mini.MINI:
+            # Loader workers reopen chunks from the chunk cache rather than being sent copies of them
+            state['prepped'] = OrderedDict()
+        return state
+
+    def get_lengths(self, field: str = 'relevant_doc_ids') -> np.ndarray:
+        """Token count of field for every row, preparing (and caching) any chunks which aren't prepared yet."""
+        chunk_count = (len(self) + CHUNK_SIZE - 1) // CHUNK_SIZE
+        return np.concatenate([self.__get_chunk(chunk_idx).lengths(field) for chunk_idx in range(chunk_count)])
+
+    def __get_cache_key(self):
+        # Chunk files are only valid for the same rows in the same order, tokenized with the same vocab. doc_text is
+        # included since a doc can be re-scraped with new text under the same doc_ref
+        digest = hashlib.blake2b(digest_size=8)
+        digest.update(pd.util.hash_pandas_object(self.data[['query', 'doc_ref', 'doc_text']], index=False).values.tobytes())
+        digest.update(models.vectors.get_vecs().fingerprint().encode('utf-8'))
+        return digest.hexdigest()
+
+    def __prepare_chunk(self, chunk_idx: int) -> PackedChunk:
+        rows = np.arange(chunk_idx * CHUNK_SIZE, min((chunk_idx + 1) * CHUNK_SIZE, len(self.data)))
+        needed_rows = [rows]
+        if self.negative_sampling == negatives.SAMPLED:
+            negative_rows = negatives.sample_negative_rows(self.query_groups, self.doc_groups, rows, np.random.default_rng(chunk_idx))
+            needed_rows.append(negative_rows)
+
+        # Tokenize each distinct doc needed by the chunk once, whether it's used as a positive or a negative
+        doc_groups = np.unique(self.doc_groups[np.concatenate(needed_rows)])
+        doc_rows = self.data[['doc_text']].iloc[self.doc_group_first_rows[doc_groups]]
+        doc_ids = doc_rows.swifter.progress_bar(enable=True, desc=f"Preloading docs for chunk {chunk_idx}").apply(lambda row: models.doc_embedder.get_ids_for_doc(row['doc_text']), axis=1)
+        doc_ids_by_group = dict(zip(doc_groups, doc_ids))
+
+        query_rows = self.data[['query']].iloc[rows]
+        query_ids = query_rows.swifter.progress_bar(enable=True, desc=f"Preloading queries for chunk {chunk_idx}").apply(lambda row: models.query_embedder.get_ids_for_query(row['query']), axis=1)
+
+        prepared = {
+            'query_ids': query_ids.tolist(),
+            'relevant_doc_ids': [doc_ids_by_group[group] for group in self.doc_groups[rows]]
+        }
+        if self.negative_sampling == negatives.SAMPLED:
+            prepared['irrelevant_doc_ids'] = [doc_ids_by_group[group] for group in self.doc_groups[negative_rows]]
+
+        arrays = {}
+        for field in self.fields:
+            arrays[field], arrays[f"{field}_offsets"] = pack_ids(prepared[field])
+        return PackedChunk(arrays)
+
+    def __get_chunk(self, chunk_idx: int) -> PackedChunk:
+        if chunk_idx in self.prepped:
+            self.prepped.move_to_end(chunk_idx)
+            return self.prepped[chunk_idx]
+
+        chunk_path = os.path.join(self.cache_dir, f"chunk-{chunk_idx}.generated")
+        try:
+            if mini.MINI:
+                raise FileNotFoundError('CACHE MISS: Mini mode, not loading')
+            chunk = PackedChunk.load(chunk_path, self.fields)
+            print('CACHE HIT: Got existing chunk from file...')
+        except FileNotFoundError:
+            chunk = self.__prepare_chunk(chunk_idx)
+            if not mini.MINI:
+                Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+                chunk.save(chunk_path)
+                # Reopen from disk so the chunk is memory mapped rather than held in RAM
+                chunk = PackedChunk.load(chunk_path, self.fields)
+            print('> Done')
+
+        self.prepped[chunk_idx] = chunk
+        while len(self.prepped) > MAX_RESIDENT_CHUNKS:
+            self.prepped.popitem(last=False)
+        return chunk
+
+    def __getitem__(self, idx: int) -> dict:
         chunk_idx = idx // CHUNK_SIZE
 
         chunk = self.__get_chunk(chunk_idx)
 
         idx_in_chunk = idx % CHUNK_SIZE
-        
-        return chunk.iloc[idx_in_chunk]
 
-def pad_batch_values(values: list):
+        item = {field: chunk.get_ids(field, idx_in_chunk) for field in self.fields}
+        item['query_group'] = self.query_groups[idx]
+        item['doc_group'] = self.doc_groups[idx]
+
+        return item
+
+def pack_batch_ids(batches: dict, extras: dict = {}, pin_memory: bool = False) -> dict:
+    """
+    Pad each named batch of token ids into one contiguous int64 buffer, so the whole lot moves to the device in one copy.
+
+    extras are flat integer arrays (eg. groups) stored in the same buffer. Returns the buffer, its layout and a
+    <name>_lengths cpu tensor per batch, use batch_to_device to get the padded tensors.
+    """
+    lengths = {name: np.fromiter((len(ids) for ids in values), dtype=np.int64, count=len(values)) for name, values in batches.items()}
+    shapes = {name: (len(values), int(lengths[name].max())) for name, values in batches.items()}
+    shapes.update({name: (len(values),) for name, values in extras.items()})
+
+    buffer = torch.empty(sum(int(np.prod(shape)) for shape in shapes.values()), dtype=torch.int64, pin_memory=pin_memory)
+    flat = buffer.numpy()
+
+    layout = []
+    offset = 0
+    for name, shape in shapes.items():
+        size = int(np.prod(shape))
+        view = flat[offset:offset + size].reshape(shape)
+        if name in batches:
+            view.fill(models.vectors.UNK_ID)
+            # Row major, so the mask's True positions line up with the ids concatenated in order
+            view[np.arange(shape[1]) < lengths[name][:, None]] = np.concatenate(batches[name])
+        else:
+            view[:] = extras[name]
+        layout.append((name, offset, shape))
+        offset += size
+
+    packed = {'buffer': buffer, 'layout': tuple(layout)}
+    for name, name_lengths in lengths.items():
+        packed[f"{name.removesuffix('_ids')}_lengths"] = torch.from_numpy(name_lengths)
+    return packed
+
+def batch_to_device(packed: dict, device: torch.device = device) -> dict:
+    """Copy a batch from pack_batch_ids to device in a single transfer and split it back into named tensors."""
+    buffer = packed['buffer'].to(device, non_blocking=True)
+    batch = {name: buffer[offset:offset + int(np.prod(shape))].view(shape) for name, offset, shape in packed['layout']}
+    # Lengths stay on the cpu, pack_padded_sequence needs them there
+    batch.update({name: value for name, value in packed.items() if name.endswith('_lengths')})
+    return batch
+
+def should_pin(device: torch.device = device) -> bool:
+    # Pinned memory can't be handed between processes, so loader workers leave pinning to the DataLoader
+    return device.type == 'cuda' and torch.utils.data.get_worker_info() is None
+
+def pad_batch_ids(values: list, device: torch.device = device):
     if type(values) is not list:
         raise ValueError("Input values must be a list (batches)")
-    if type(values[0]) is not list:
-        raise ValueError(f"Input values must be a list (batches) of lists (tokens in batch), got type {type(values[0])} at values[0]")
-    if type(values[0][0]) is not np.ndarray:
-        raise ValueError(f"Input values must be a list (batches) of lists (tokens in batch) of numpy arrays (token embeddings), got {type(values[0][0])} at values[0][0]")
-    if not isinstance(values[0][0], np.ndarray) or values[0][0].dtype != np.float32:
-        raise ValueError(f"Input values must be a list (batches) of lists (tokens in batch) of numpy arrays of dtype float32 (token embeddings), got dtype {type(values[0][0].dtype)}")
-    tensors = [torch.tensor(np.array(item)).to(device) for item in values]
-
-    padded_values = torch.nn.utils.rnn.pad_sequence(tensors, batch_first=True, padding_value=0).float()
-    original_lengths = torch.tensor([len(x) for x in values])
-
-    return padded_values, original_lengths
-
-def collate_two_tower_batch(batch: list):
-    query_embeddings, query_embedding_lengths = pad_batch_values([item['query_embeddings'] for item in batch])
-    relevant_doc_embeddings, relevant_doc_embedding_lengths = pad_batch_values([item['relevant_doc_embeddings'] for item in batch])
-    irrelevant_doc_embeddings, irrelevant_doc_embedding_lengths = pad_batch_values([item['irrelevant_doc_embeddings'] for item in batch])
-
-    return {
-        'query_embeddings': query_embeddings,
-        'query_embedding_lengths': query_embedding_lengths,
-        'relevant_doc_embeddings': relevant_doc_embeddings,
-        'relevant_doc_embedding_lengths': relevant_doc_embedding_lengths,
-        'irrelevant_doc_embeddings': irrelevant_doc_embeddings,
-        'irrelevant_doc_embedding_lengths': irrelevant_doc_embedding_lengths
+    if not isinstance(values[0], (list, np.ndarray)):
+        raise ValueError(f"Input values must be a list (batches) of lists or arrays (token ids in batch), got type {type(values[0])} at values[0]")
+
+    batch = batch_to_device(pack_batch_ids({'ids': values}, pin_memory=should_pin(device)), device)
+
+    return batch['ids'], batch['ids_lengths']
+
+def pack_two_tower_batch(batch: list, pin_memory: bool = False) -> dict:
+    fields = [field for field in FIELDS if field in batch[0]]
+    return pack_batch_ids(
+        {field: [item[field] for item in batch] for field in fields},
+        {
+            'query_groups': np.fromiter((item['query_group'] for item in batch), dtype=np.int64, count=len(batch)),
+            'doc_groups': np.fromiter((item['doc_group'] for item in batch), dtype=np.int64, count=len(batch))
+        },
+        pin_memory
+    )
+
+def collate_two_tower_batch(batch: list, device: torch.device = device):
+    return batch_to_device(pack_two_tower_batch(batch, should_pin(device)), device)
+
+class LengthBucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Yields batches of row indices where each batch holds rows of similar length.
+
+    Each epoch, chunks are visited in a random order. The rows of a chunk are shuffled and split into pools of
+    batch_size * bucket_batches rows, each pool is sorted by length and cut into batches, and then the chunk's batches
+    are shuffled. Batches never span chunks, so a loader worker only needs a few chunks open at a time.
+
+    With a world_size above 1, every process generates the same batches and keeps every world_size'th one starting
+    from its rank. Leftover batches are dropped so that every process takes the same number of steps.
+    """
+    def __init__(self, lengths: np.ndarray, batch_size: int, shuffle: bool = True, bucket_batches: int = BUCKET_BATCHES, seed: int = 16, rank: int = 0, world_size: int = 1):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_size = batch_size * bucket_batches
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+
+    def __len__(self):
+        return self.__total_batches() // self.world_size
+
+    def __total_batches(self) -> int:
+        return sum((min(CHUNK_SIZE, len(self.lengths) - start) + self.batch_size - 1) // self.batch_size for start in range(0, len(self.lengths), CHUNK_SIZE))
+
+    def __iter__(self):
+        batch_count = len(self)
+        yielded = 0
+        for i, batch in enumerate(self.__iter_all()):
+            if yielded == batch_count:
+                return
+            if i % self.world_size == self.rank:
+                yielded += 1
+                yield batch
+
+    def __iter_all(self):
+        rng = np.random.default_rng((self.seed, self.epoch))
+        self.epoch += 1
+
+        chunk_starts = np.arange(0, len(self.lengths), CHUNK_SIZE)
+        if self.shuffle:
+            chunk_starts = rng.permutation(chunk_starts)
+
+        for chunk_start in chunk_starts:
+            rows = np.arange(chunk_start, min(chunk_start + CHUNK_SIZE, len(self.lengths)))
+            if self.shuffle:
+                rows = rng.permutation(rows)
+
+            batches = []
+            for pool_start in range(0, len(rows), self.pool_size):
+                pool = rows[pool_start:pool_start + self.pool_size]
+                # Stable, so rows of equal length keep their shuffled order
+                pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+                batches.extend(pool[start:start + self.batch_size] for start in range(0, len(pool), self.batch_size))
+
+            if self.shuffle:
+                batches = [batches[i] for i in rng.permutation(len(batches))]
+
+            for batch in batches:
+                yield batch.tolist()
+
+def get_loader(two_tower_dataset: TwoTowerDataset, batch_size: int, shuffle: bool = True, rank: int = 0, world_size: int = 1) -> torch.utils.data.DataLoader:
+    """
+    DataLoader for training on two_tower_dataset, with length bucketed batches and LOADER_WORKERS worker processes.
+
+    With a world_size above 1 the loader only yields rank's share of the batches, the same number for every rank.
+    Call set_loader_epoch at the start of every epoch so that each epoch is shuffled differently.
+
+    Batches come out packed into a single (pinned when training on cuda) buffer, move them with batch_to_device before use.
+    """
+    loader_options = {
+        # Without workers the buffer is allocated pinned up front, rather than copied into pinned memory afterwards
+        'collate_fn': partial(pack_two_tower_batch, pin_memory=should_pin() and LOADER_WORKERS == 0),
+        'num_workers': LOADER_WORKERS,
+        'pin_memory': device.type == 'cuda' and LOADER_WORKERS > 0
     }
+    if LOADER_WORKERS > 0:
+        # Workers live for the whole run, so the chunks each has open carry over between epochs
+        loader_options['persistent_workers'] = True
+        loader_options['prefetch_factor'] = LOADER_PREFETCH
+
+    if not LENGTH_BUCKETING:
+        if world_size == 1:
+            return torch.utils.data.DataLoader(two_tower_dataset, batch_size=batch_size, shuffle=shuffle, **loader_options)
+        sampler = torch.utils.data.distributed.DistributedSampler(two_tower_dataset, num_replicas=world_size, rank=rank, shuffle=shuffle, seed=16, drop_last=True)
+        return torch.utils.data.DataLoader(two_tower_dataset, batch_size=batch_size, sampler=sampler, drop_last=True, **loader_options)
+
+    # Prepares every chunk up front, so workers only ever read chunks from the cache
+    lengths = two_tower_dataset.get_lengths()
+    batch_sampler = LengthBucketBatchSampler(lengths, batch_size, shuffle, rank=rank, world_size=world_size)
+    return torch.utils.data.DataLoader(two_tower_dataset, batch_sampler=batch_sampler, **loader_options)
+
+def set_loader_epoch(loader: torch.utils.data.DataLoader, epoch: int):
+    # Length bucketed batches are reshuffled by the sampler itself, DistributedSampler needs telling the epoch
+    if isinstance(loader.sampler, torch.utils.data.distributed.DistributedSampler):
+        loader.sampler.set_epoch(epoch)
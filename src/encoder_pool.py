@@ -0,0 +1,61 @@
+import collections
+import multiprocessing
+import os
+import concurrent.futures
+import torch
+
+import models
+import models.doc_projector, models.quantization, models.vectors
+import inference
+
+# Doc encoder processes, each runs single threaded so throughput scales with the number of cores
+WORKERS = int(os.environ.get('ENCODE_WORKERS', str(os.cpu_count() or 1)))
+
+# Batches submitted to the pool ahead of the one being waited on, per worker
+IN_FLIGHT_PER_WORKER = 2
+
+encoder = None
+
+def _init_worker(doc_state_dict: dict, quantize: bool):
+    global encoder
+    # One thread per process, the pool provides the parallelism and threads would only compete for cores
+    torch.set_num_threads(1)
+    # Word vectors are memory mapped, so every worker shares the same pages through the OS page cache
+    encoder = models.doc_projector.Model()
+    encoder.load_state_dict(doc_state_dict)
+    encoder.eval()
+    if quantize:
+        encoder = models.quantization.quantize(encoder)
+
+def _encode(doc_texts: list) -> list:
+    return inference.get_doc_encodings(encoder, doc_texts, device=torch.device('cpu'))
+
+class EncoderPool:
+    """
+    Encodes batches of docs across a pool of cpu processes, each with its own doc projector.
+
+    map keeps at most IN_FLIGHT_PER_WORKER batches per worker submitted at a time, and yields results in
+    submission order, so a slow consumer holds back encoding rather than letting results pile up in memory.
+    """
+    def __init__(self, doc_state_dict: dict, quantize: bool = False, workers: int = WORKERS):
+        self.workers = workers
+        # Spawned rather than forked, forking a process which has already used torch's thread pools can deadlock
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker, initargs=(doc_state_dict, quantize))
+
+    def map(self, batches):
+        in_flight = collections.deque()
+        for batch in batches:
+            if len(in_flight) >= self.workers * IN_FLIGHT_PER_WORKER:
+                yield in_flight.popleft().result()
+            in_flight.append(self.executor.submit(_encode, batch))
+        while in_flight:
+            yield in_flight.popleft().result()
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,35 @@
+import os
+
+from indexes import chroma_index, local_index
+
+# 'chroma' (collection on the chroma server) or 'local' (memory mapped matrix searched in process)
+BACKEND = os.environ.get('VECTOR_INDEX', 'chroma')
+
+BACKENDS = {
+    'chroma': chroma_index,
+    'local': local_index
+}
+
+def get_backend(backend: str = None):
+    backend = backend or BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown vector index backend {backend}, expected one of {', '.join(BACKENDS)}")
+    return BACKENDS[backend]
+
+def open_index(name: str = 'docs', backend: str = None):
+    """Open an existing index, raises if it doesn't exist."""
+    return get_backend(backend).open_index(name)
+
+def create_index(name: str = 'docs', backend: str = None):
+    """Create an empty index, replacing any existing index with the same name."""
+    return get_backend(backend).create_index(name)
+
+def delete_index(name: str = 'docs', backend: str = None):
+    get_backend(backend).delete_index(name)
+
+def index_exists(name: str = 'docs', backend: str = None) -> bool:
+    return get_backend(backend).index_exists(name)
+
+def swap_index(source: str, target: str = 'docs', backend: str = None):
+    """Replace the target index with the source index, which no longer exists under its own name afterwards."""
+    get_backend(backend).swap_index(source, target)
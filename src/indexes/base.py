@@ -0,0 +1,20 @@
+class VectorIndex:
+    """
+    Interface for a store of doc vectors keyed by doc_ref, searchable by cosine similarity.
+
+    Implemented by indexes.chroma_index (a collection on the chroma server) and indexes.local_index
+    (a memory mapped matrix in this process). Use indexes.backends to open one.
+    """
+    def add(self, ids: list, embeddings: list):
+        """Store embeddings under ids, replacing any existing vectors for the same ids."""
+        raise NotImplementedError()
+
+    def delete(self, ids: list):
+        raise NotImplementedError()
+
+    def query(self, embeddings: list, k: int) -> list:
+        """Return the ids of the k nearest vectors for each query embedding, nearest first."""
+        raise NotImplementedError()
+
+    def count(self) -> int:
+        raise NotImplementedError()
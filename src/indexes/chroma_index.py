@@ -0,0 +1,54 @@
+from indexes import base
+
+class ChromaIndex(base.VectorIndex):
+    def __init__(self, collection):
+        self.collection = collection
+
+    def add(self, ids: list, embeddings: list):
+        self.collection.upsert(ids=ids, embeddings=embeddings)
+
+    def delete(self, ids: list):
+        self.collection.delete(ids=ids)
+
+    def query(self, embeddings: list, k: int) -> list:
+        return self.collection.query(query_embeddings=embeddings, n_results=k)['ids']
+
+    def count(self) -> int:
+        return self.collection.count()
+
+def open_index(name: str) -> ChromaIndex:
+    # Imported here so processes using another backend never connect to chroma
+    from util import chroma
+    return ChromaIndex(chroma.client.get_collection(name=name))
+
+def create_index(name: str) -> ChromaIndex:
+    from util import chroma
+    delete_index(name)
+    return ChromaIndex(chroma.client.create_collection(name=name, metadata={"hnsw:space": "cosine"}))
+
+def delete_index(name: str):
+    from util import chroma
+    try:
+        chroma.client.delete_collection(name=name)
+    except Exception:
+        # Didn't exist
+        pass
+
+def index_exists(name: str) -> bool:
+    try:
+        open_index(name)
+        return True
+    except Exception:
+        return False
+
+def swap_index(source: str, target: str):
+    """Rename the source collection to target, replacing the existing target collection."""
+    from util import chroma
+    source_collection = chroma.client.get_collection(name=source)
+    old_name = None
+    if index_exists(target):
+        old_name = f"{target}-old-{source}"
+        chroma.client.get_collection(name=target).modify(name=old_name)
+    source_collection.modify(name=target)
+    if old_name is not None:
+        delete_index(old_name)
@@ -0,0 +1,285 @@
+import json
+import os
+import shutil
+import uuid
+import numpy as np
+
+from indexes import base
+from util import atomic, constants
+
+# Use an HNSW graph (via hnswlib, which comes with chromadb) instead of exact search
+ANN = int(os.environ.get('LOCAL_INDEX_ANN', '0')) == 1
+HNSW_M = int(os.environ.get('HNSW_M', '16'))
+HNSW_EF_CONSTRUCTION = int(os.environ.get('HNSW_EF_CONSTRUCTION', '200'))
+HNSW_EF = int(os.environ.get('HNSW_EF', '64'))
+
+# Rows scored per matrix multiply during exact search, bounds memory for big indexes
+BLOCK_ROWS = 65536
+
+FLOAT32 = 'float32'
+FLOAT16 = 'float16'
+# Scalar quantized, each row stored as int8 codes plus a float32 scale
+INT8 = 'int8'
+
+# On disk file and numpy dtype for each way of storing vectors
+VECTOR_DTYPES = {
+    FLOAT32: ('vectors.f32', np.float32),
+    FLOAT16: ('vectors.f16', np.float16),
+    INT8: ('vectors.i8', np.int8)
+}
+
+# How vectors are stored in newly created indexes, smaller types trade some recall for memory (see `pdm run quant-report`)
+VECTOR_DTYPE = os.environ.get('LOCAL_INDEX_DTYPE', FLOAT32)
+
+def get_index_path(name: str) -> str:
+    return os.path.join(constants.DATA_PATH, 'indexes', f"{name}.generated")
+
+def _normalize(embeddings) -> np.ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+class LocalIndex(base.VectorIndex):
+    """
+    Doc vectors stored in this process, as a memory mapped matrix of unit vectors (float32, float16 or int8 codes).
+
+    Rows are only ever appended. Deleting (or re-adding) an id writes a tombstone for its old row, so writes
+    cost O(batch) rather than rewriting the matrix. Queries use exact cosine top-k over the whole matrix,
+    or an HNSW graph when ann is set.
+
+    Files are read when the index is opened, so another process's writes only show up after reopening.
+    """
+    def __init__(self, path: str, ann: bool = ANN, hnsw_m: int = HNSW_M, hnsw_ef_construction: int = HNSW_EF_CONSTRUCTION, hnsw_ef: int = HNSW_EF):
+        # Resolved once, so a later swap_index doesn't change which files this instance reads and writes
+        self.path = os.path.realpath(path)
+        self.ann = ann
+        self.hnsw_m = hnsw_m
+        self.hnsw_ef_construction = hnsw_ef_construction
+        self.hnsw_ef = hnsw_ef
+        self.hnsw = None
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        # Indexes created before vector dtypes existed are float32
+        self.dtype = self.meta.get('dtype', FLOAT32)
+        self.vectors_file, self.numpy_dtype = VECTOR_DTYPES[self.dtype]
+        self._load()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _load(self):
+        dim = self.meta.get('dim')
+        with open(self._file('ids.txt')) as f:
+            self.ids = f.read().splitlines()
+
+        vector_rows = os.path.getsize(self._file(self.vectors_file)) // (np.dtype(self.numpy_dtype).itemsize * dim) if dim else 0
+        if self.dtype == INT8:
+            vector_rows = min(vector_rows, os.path.getsize(self._file('scales.f32')) // 4)
+        # A write interrupted between the vectors and the ids leaves rows without ids, ignore them
+        row_count = min(len(self.ids), vector_rows)
+        self.ids = self.ids[:row_count]
+        self._map_vectors()
+
+        deleted_rows = np.fromfile(self._file('deleted.i64'), dtype=np.int64)
+        self.live = np.ones(row_count, dtype=bool)
+        self.live[deleted_rows[deleted_rows < row_count]] = False
+        self.rows_by_id = {id: row for row, id in enumerate(self.ids) if self.live[row]}
+
+    def _map_vectors(self):
+        if self.ids:
+            self.vectors = np.memmap(self._file(self.vectors_file), dtype=self.numpy_dtype, mode='r', shape=(len(self.ids), self.meta['dim']))
+        else:
+            self.vectors = np.zeros((0, self.meta.get('dim') or 0), dtype=self.numpy_dtype)
+        if self.dtype == INT8:
+            self.scales = np.memmap(self._file('scales.f32'), dtype=np.float32, mode='r', shape=(len(self.ids),)) if self.ids else np.zeros(0, dtype=np.float32)
+        self.hnsw = None
+
+    def _encode(self, embeddings: np.ndarray) -> tuple:
+        if self.dtype == INT8:
+            # Symmetric per row scale, so each row uses the full int8 range
+            scales = np.maximum(np.abs(embeddings).max(axis=1), 1e-12) / 127
+            return np.round(embeddings / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+        return embeddings.astype(self.numpy_dtype), None
+
+    def _decode(self, start: int, stop: int) -> np.ndarray:
+        """Rows start to stop as float32 unit vectors (approximately, for quantized dtypes)."""
+        vectors = np.asarray(self.vectors[start:stop], dtype=np.float32)
+        if self.dtype == INT8:
+            vectors *= self.scales[start:stop, None]
+        return vectors
+
+    def _tombstone(self, ids: list):
+        rows = [self.rows_by_id.pop(id) for id in ids if id in self.rows_by_id]
+        if not rows:
+            return
+        self.live[rows] = False
+        with open(self._file('deleted.i64'), 'ab') as f:
+            f.write(np.array(rows, dtype=np.int64).tobytes())
+        self.hnsw = None
+
+    def add(self, ids: list, embeddings: list):
+        if len(ids) == 0:
+            return
+        embeddings = _normalize(embeddings)
+        if self.meta.get('dim') is None:
+            self.meta['dim'] = embeddings.shape[1]
+            with open(self._file('meta.json'), 'w') as f:
+                json.dump(self.meta, f)
+        elif embeddings.shape[1] != self.meta['dim']:
+            raise ValueError(f"Expected embeddings of dimension {self.meta['dim']}, got {embeddings.shape[1]}")
+
+        # Adding an existing id replaces it
+        self._tombstone(ids)
+
+        codes, scales = self._encode(embeddings)
+        with open(self._file(self.vectors_file), 'ab') as f:
+            f.write(codes.tobytes())
+        if scales is not None:
+            with open(self._file('scales.f32'), 'ab') as f:
+                f.write(scales.tobytes())
+        with open(self._file('ids.txt'), 'a') as f:
+            f.write(''.join(f"{id}\n" for id in ids))
+
+        first_row = len(self.ids)
+        self.ids.extend(ids)
+        self.live = np.concatenate([self.live, np.ones(len(ids), dtype=bool)])
+        self.rows_by_id.update((id, first_row + i) for i, id in enumerate(ids))
+        self._map_vectors()
+
+    def delete(self, ids: list):
+        self._tombstone(ids)
+
+    def count(self) -> int:
+        return len(self.rows_by_id)
+
+    def query(self, embeddings: list, k: int) -> list:
+        k = min(k, self.count())
+        if k == 0:
+            return [[] for _ in embeddings]
+        queries = _normalize(embeddings)
+        if self.ann:
+            rows = self._ann_query(queries, k)
+        else:
+            rows = self._exact_query(queries, k)
+        return [[self.ids[row] for row in query_rows] for query_rows in rows]
+
+    def _exact_query(self, queries: np.ndarray, k: int) -> list:
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+
+        for start in range(0, len(self.ids), BLOCK_ROWS):
+            scores = queries @ self._decode(start, start + BLOCK_ROWS).T
+            dead = ~self.live[start:start + BLOCK_ROWS]
+            if dead.any():
+                scores[:, dead] = -np.inf
+
+            candidate_scores = np.concatenate([best_scores, scores], axis=1)
+            candidate_rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)], axis=1)
+
+            # Keep only the running top k per query
+            if candidate_scores.shape[1] > k:
+                top = np.argpartition(-candidate_scores, k - 1, axis=1)[:, :k]
+                candidate_scores = np.take_along_axis(candidate_scores, top, axis=1)
+                candidate_rows = np.take_along_axis(candidate_rows, top, axis=1)
+            best_scores, best_rows = candidate_scores, candidate_rows
+
+        order = np.argsort(-best_scores, axis=1, kind='stable')
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+
+        return [rows[np.isfinite(scores)].tolist() for rows, scores in zip(best_rows, best_scores)]
+
+    def _get_hnsw(self):
+        if self.hnsw is not None:
+            return self.hnsw
+
+        import hnswlib
+
+        hnsw = hnswlib.Index(space='cosine', dim=self.meta['dim'])
+        hnsw_path = self._file('hnsw.bin')
+        signature = {'rows': len(self.ids), 'live': self.count(), 'm': self.hnsw_m, 'ef_construction': self.hnsw_ef_construction}
+        try:
+            with open(self._file('hnsw.json')) as f:
+                saved_signature = json.load(f)
+        except FileNotFoundError:
+            saved_signature = None
+
+        if saved_signature == signature:
+            hnsw.load_index(hnsw_path, max_elements=len(self.ids))
+        else:
+            print('Building HNSW graph for local index...')
+            live_rows = np.flatnonzero(self.live)
+            hnsw.init_index(max_elements=max(1, len(self.ids)), ef_construction=self.hnsw_ef_construction, M=self.hnsw_m)
+            hnsw.add_items(self._decode(0, len(self.ids))[live_rows], live_rows)
+            hnsw.save_index(hnsw_path)
+            with open(self._file('hnsw.json'), 'w') as f:
+                json.dump(signature, f)
+            print('> Done')
+
+        self.hnsw = hnsw
+        return hnsw
+
+    def _ann_query(self, queries: np.ndarray, k: int) -> list:
+        hnsw = self._get_hnsw()
+        # ef below k makes hnswlib fail to return k results
+        hnsw.set_ef(max(self.hnsw_ef, k))
+        rows, _ = hnsw.knn_query(queries, k=k)
+        return rows.tolist()
+
+def open_index(name: str) -> LocalIndex:
+    path = get_index_path(name)
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        raise FileNotFoundError(f"No local index named {name}")
+    return LocalIndex(path)
+
+def create_index(name: str, dtype: str = VECTOR_DTYPE) -> LocalIndex:
+    if dtype not in VECTOR_DTYPES:
+        raise ValueError(f"Unknown vector dtype {dtype}, expected one of {', '.join(VECTOR_DTYPES)}")
+    delete_index(name)
+
+    # Files live in a uniquely named directory behind a symlink, so swap_index can replace an index atomically
+    data_path = os.path.join(constants.DATA_PATH, 'indexes', f"{name}-{uuid.uuid4().hex[:8]}.generated-data")
+    os.makedirs(data_path)
+    for file in [VECTOR_DTYPES[dtype][0], 'scales.f32', 'ids.txt', 'deleted.i64']:
+        open(os.path.join(data_path, file), 'wb').close()
+    with open(os.path.join(data_path, 'meta.json'), 'w') as f:
+        json.dump({'dim': None, 'dtype': dtype}, f)
+    os.symlink(data_path, get_index_path(name))
+
+    return LocalIndex(get_index_path(name))
+
+def delete_index(name: str):
+    path = get_index_path(name)
+    if os.path.islink(path):
+        shutil.rmtree(os.path.realpath(path), ignore_errors=True)
+        os.unlink(path)
+    else:
+        shutil.rmtree(path, ignore_errors=True)
+
+def index_exists(name: str) -> bool:
+    return os.path.exists(os.path.join(get_index_path(name), 'meta.json'))
+
+def swap_index(source: str, target: str):
+    """
+    Replace the target index with the source index.
+
+    The target symlink is replaced with a single rename, so a process opening target always sees either
+    the complete old index or the complete new one.
+    """
+    source_path = get_index_path(source)
+    target_path = get_index_path(target)
+
+    old_data_path = None
+    if os.path.islink(target_path):
+        old_data_path = os.path.realpath(target_path)
+    elif os.path.exists(target_path):
+        old_data_path = f"{target_path}.old-{os.getpid()}"
+        os.rename(target_path, old_data_path)
+
+    with atomic.writing(target_path) as link_path:
+        os.symlink(os.path.realpath(source_path), link_path)
+    os.unlink(source_path)
+
+    if old_data_path is not None:
+        # Processes which already opened the old index keep their memory maps until they reopen
+        shutil.rmtree(old_data_path, ignore_errors=True)
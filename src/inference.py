@@ -1,73 +1,243 @@
-import pandas as pd
+import json
+import os
+import random
+import uuid
+import numpy as np
 import torch
 
-from util import artifacts, constants, chroma, devices
+from util import artifacts, constants, devices, doc_store, cache, metrics, columnar
+from indexes import backends
 import models
 import dataset
-import models.query_embedder, models.query_projector, models.doc_projector, models.vectors
+import models.query_embedder, models.query_projector, models.doc_projector, models.vectors, models.quantization, models.export
 
 MAX_RESULTS = 5
 
+# Max docs per doc projector forward pass when encoding in bulk
+DOC_ENCODING_BATCH_SIZE = 256
+
+# Bounds for the projected query vector and search results caches
+QUERY_CACHE_SIZE = int(os.environ.get('QUERY_CACHE_SIZE', '10000'))
+QUERY_CACHE_TTL_SECONDS = float(os.environ.get('QUERY_CACHE_TTL_SECONDS', '3600'))
+
+# Serve the exported TorchScript query graph rather than the eager model
+SERVE_GRAPH = int(os.environ.get('SERVE_GRAPH', '0')) == 1
+
 device = devices.get_device()
 
 query_projector = None
 docs = None
+doc_index = None
+sample_queries = None
+
+query_vector_cache = cache.TTLCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL_SECONDS)
+results_cache = cache.TTLCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL_SECONDS)
+index_version = None
+# Fingerprint of the doc projector weights the current index was built with, as last seen by this process
+index_model_fingerprint = None
 
 def load_model_and_docs():
     global query_projector, docs
     if query_projector is None or docs is None:
-        query_projector = models.query_projector.Model().to(device)
+        if SERVE_GRAPH:
+            # Exported by `pdm run train` or `pdm run export`, called the same way as the eager model
+            query_graph = artifacts.load_artifact('query-projector-graph', 'graph', device)
+            query_projector = models.export.ExportedProjector(query_graph, models.vectors.get_tensor(device))
+        else:
+            query_projector = models.query_projector.Model().to(device)
 
-        query_state_dict = artifacts.load_artifact('query-projector-weights', 'model')
+            query_state_dict = artifacts.load_artifact('query-projector-weights', 'model')
 
-        query_projector.load_state_dict(query_state_dict)
-        query_projector.eval()
+            query_projector.load_state_dict(query_state_dict)
+            query_projector.eval()
+            query_projector = models.quantization.maybe_quantize(query_projector, device)
 
-        docs = pd.read_csv(constants.DOCS_PATH)
+        docs = doc_store.load()
 
     return query_projector, docs
 
+def load_trained_projectors(device: torch.device = device) -> tuple:
+    """The published query and doc projectors, in eval mode on device, for offline tools that compare or evaluate them."""
+    query_projector = models.query_projector.Model().to(device)
+    query_projector.load_state_dict(artifacts.load_artifact('query-projector-weights', 'model'))
+    query_projector.eval()
+
+    doc_projector = models.doc_projector.Model().to(device)
+    doc_projector.load_state_dict(artifacts.load_artifact('doc-projector-weights', 'model'))
+    doc_projector.eval()
+
+    return query_projector, doc_projector
+
+def reload_model():
+    """Drop the loaded projector and docs (eg. after new weights are published) along with everything cached from them."""
+    global query_projector, docs
+    query_projector = None
+    docs = None
+    query_vector_cache.clear()
+    results_cache.clear()
+
+def mark_index_updated(model_fingerprint: str = None):
+    """
+    Called whenever the doc collection changes, so searching processes drop results cached from the old one.
+
+    model_fingerprint identifies the doc projector weights the index was built with. When it changes, searching
+    processes reload the query projector too, so queries are projected by weights matching the new index.
+    """
+    with open(constants.INDEX_VERSION_PATH, 'w') as f:
+        json.dump({'version': uuid.uuid4().hex, 'model_fingerprint': model_fingerprint}, f)
+
+def read_index_model_fingerprint():
+    try:
+        with open(constants.INDEX_VERSION_PATH) as f:
+            return json.load(f).get('model_fingerprint')
+    except (FileNotFoundError, ValueError):
+        return None
+
+def check_index_version():
+    global index_version, index_model_fingerprint, doc_index
+    try:
+        version = os.stat(constants.INDEX_VERSION_PATH).st_mtime_ns
+    except FileNotFoundError:
+        version = None
+    if version != index_version:
+        results_cache.clear()
+        # Reopen so indexes which are read on open pick up the changes
+        doc_index = None
+        index_version = version
+
+        model_fingerprint = read_index_model_fingerprint()
+        if index_model_fingerprint is not None and model_fingerprint is not None and model_fingerprint != index_model_fingerprint:
+            print('INFO: Index was rebuilt with new projector weights, reloading the query projector')
+            reload_model()
+        index_model_fingerprint = model_fingerprint or index_model_fingerprint
+
+def get_doc_index():
+    global doc_index
+    if doc_index is None:
+        doc_index = backends.open_index('docs')
+    return doc_index
+
+def get_cache_stats() -> dict:
+    return {
+        'query_vectors': query_vector_cache.stats(),
+        'results': results_cache.stats()
+    }
+
 def get_random_query():
-    sample_queries = pd.read_csv(constants.SAMPLE_QUERIES_PATH)
+    global sample_queries
+    # Read once, the sample queries only change when the data is reloaded
+    if sample_queries is None:
+        sample_queries = columnar.read(constants.SAMPLE_QUERIES_PATH, ['query'])['query'].tolist()
 
-    query = sample_queries.sample(1).iloc[0]['query']
+    return random.choice(sample_queries)
 
-    return query
+def get_doc_encodings(doc_projector: models.doc_projector.Model, doc_texts: list, batch_size: int = DOC_ENCODING_BATCH_SIZE, device: torch.device = device) -> list:
+    word_vectors = models.vectors.get_vecs()
 
-def get_doc_encoding(doc_projector: models.doc_projector.Model, doc_text: str):
-    doc_embeddings = models.doc_embedder.get_embeddings_for_doc(doc_text)
+    with metrics.timed('encode.tokenize'):
+        doc_tokens = [models.doc_embedder.get_tokens_for_doc(doc_text) for doc_text in doc_texts]
 
-    batch, lengths = dataset.pad_batch_values([doc_embeddings])
+    with metrics.timed('encode.vector_lookup'):
+        doc_ids = [word_vectors.get_ids(tokens) for tokens in doc_tokens]
 
-    encoded, _ = doc_projector(batch, lengths)
-    encoded_list = encoded.detach().tolist()
+    # Sort by token count so each forward pass groups docs of similar length and padding stays small
+    order = np.argsort([len(ids) for ids in doc_ids], kind='stable')
 
-    if (len(encoded_list) > 1):
-        raise ValueError(f"Expected 1 encoded vector, got {len(encoded_list)}")
-    
-    encoded_item = encoded_list[0]
+    encoded = [None] * len(doc_ids)
 
-    return encoded_item
+    with torch.inference_mode():
+        for start in range(0, len(order), batch_size):
+            batch_indices = order[start:start + batch_size]
+
+            with metrics.timed('encode.pad'):
+                batch, lengths = dataset.pad_batch_ids([doc_ids[i] for i in batch_indices], device)
+
+            with metrics.timed('encode.forward'):
+                encoded_batch, _ = doc_projector(batch, lengths)
+                encoded_batch = encoded_batch.tolist()
+
+            for i, encoded_item in zip(batch_indices, encoded_batch):
+                encoded[i] = encoded_item
+
+    return encoded
+
+def get_query_encodings(query_projector: models.query_projector.Model, queries: list, use_cache: bool = True) -> list:
+    """
+    Projected vector for each query, or None for queries with no tokens.
+
+    use_cache=False neither reads nor fills the server's query vector cache, eg. when encoding with projectors other than the served one.
+    """
+    encoded_queries = {}
+    uncached_queries = []
+    for query in queries:
+        if query in encoded_queries:
+            continue
+        encoded_query = query_vector_cache.get(query) if use_cache else None
+        if encoded_query is None:
+            uncached_queries.append(query)
+        encoded_queries[query] = encoded_query
+
+    if uncached_queries:
+        word_vectors = models.vectors.get_vecs()
+
+        with metrics.timed('search.tokenize'):
+            batch = [models.query_embedder.get_tokens_for_query(query) for query in uncached_queries]
+
+        with metrics.timed('search.vector_lookup'):
+            batch = [word_vectors.get_ids(tokens) for tokens in batch]
+
+        # Queries with no tokens (eg. blank or only punctuation) can't be run through the projector, they stay None
+        uncached_queries = [query for query, ids in zip(uncached_queries, batch) if len(ids) > 0]
+        batch = [ids for ids in batch if len(ids) > 0]
+
+    if uncached_queries:
+        with metrics.timed('search.pad'):
+            padded_ids, lengths = dataset.pad_batch_ids(batch)
+
+        with metrics.timed('search.forward'), torch.inference_mode():
+            encoded_query_batch, _ = query_projector(padded_ids, lengths)
+            encoded_query_batch = encoded_query_batch.tolist()
+
+        for query, encoded_query in zip(uncached_queries, encoded_query_batch):
+            if use_cache:
+                query_vector_cache.set(query, encoded_query)
+            encoded_queries[query] = encoded_query
+
+    return [encoded_queries[query] for query in queries]
+
+def search_batch(queries: list, k: int = MAX_RESULTS) -> list:
+    """Search for many queries at once, with one projector forward pass and one vector search for all uncached queries."""
+    with metrics.timed('search.total'):
+        return _search_batch(queries, k)
+
+def _search_batch(queries: list, k: int) -> list:
+    # First, so a projector change picked up here is loaded below
+    check_index_version()
 
-def search(query: str):
     query_projector, docs = load_model_and_docs()
 
-    query_embeddings = models.query_embedder.get_embeddings_for_query(query)
+    nearest_doc_refs = [results_cache.get((query, k)) for query in queries]
+    uncached_queries = list(dict.fromkeys(query for query, refs in zip(queries, nearest_doc_refs) if refs is None))
 
-    batch = [query_embeddings]
+    if uncached_queries:
+        encoded_queries = get_query_encodings(query_projector, uncached_queries)
 
-    padded_embeddings, lengths = dataset.pad_batch_values(batch)
+        # Queries with nothing to encode have no results
+        refs_by_query = {query: [] for query, encoded_query in zip(uncached_queries, encoded_queries) if encoded_query is None}
+        searchable_queries = [query for query in uncached_queries if query not in refs_by_query]
 
-    encoded_query_batch, _ = query_projector(padded_embeddings, lengths)
-    
-    encoded_query_batch_list = encoded_query_batch.detach().tolist()
+        if searchable_queries:
+            with metrics.timed('search.index_query'):
+                nearest_docs = get_doc_index().query([encoded_query for encoded_query in encoded_queries if encoded_query is not None], k)
+            refs_by_query.update(zip(searchable_queries, nearest_docs))
 
-    collection = chroma.client.get_collection(name="docs")
-    nearest_docs = collection.query(
-        query_embeddings=encoded_query_batch_list,
-        n_results=5,
-    )
-    nearest_doc_refs = nearest_docs['ids'][0]
-    nearest_docs = [docs[docs['doc_ref'] == id].iloc[0].to_dict() for id in nearest_doc_refs]
+        for query, refs in refs_by_query.items():
+            results_cache.set((query, k), refs)
 
-    return nearest_docs
+        nearest_doc_refs = [refs if refs is not None else refs_by_query[query] for query, refs in zip(queries, nearest_doc_refs)]
+
+    with metrics.timed('search.hydrate'):
+        return [[docs[id] for id in refs] for refs in nearest_doc_refs]
+
+def search(query: str):
+    return search_batch([query])[0]
@@ -1,5 +1,5 @@
 import torch
-from models import doc_embedder
+from models import doc_embedder, vectors
 
 DOC_HIDDEN_LAYER_DIMENSION = 128
 
@@ -7,9 +7,11 @@ OUTPUT_DIMENSION = 256
 
 DROPOUT = 0.1
 
-class Model(torch.nn.Module):
+class Model(vectors.WordVectorsModule):
     def __init__(self):
+        # Sets up the word_vectors buffer used to look up token ids
         super(Model, self).__init__()
+
         self.rnn = torch.nn.LSTM(
             input_size=doc_embedder.EMBEDDING_DIM,
             hidden_size=DOC_HIDDEN_LAYER_DIMENSION,
@@ -19,7 +21,14 @@ class Model(torch.nn.Module):
         # Final projection layer
         self.project = torch.nn.Linear(DOC_HIDDEN_LAYER_DIMENSION, OUTPUT_DIMENSION)
 
+    def embed(self, doc_ids: torch.Tensor) -> torch.Tensor:
+        return torch.nn.functional.embedding(doc_ids, self.word_vectors)
+
     def forward(self, doc_embeddings: torch.Tensor, lengths: torch.Tensor) -> torch.Tensor:
+        # Accept a padded batch of token ids as well as already embedded tokens
+        if not torch.is_floating_point(doc_embeddings):
+            doc_embeddings = self.embed(doc_embeddings)
+
         max_len = torch.max(lengths).item()
         expected_shape = [max_len, doc_embedder.EMBEDDING_DIM]
         if list(doc_embeddings.shape)[1:] != expected_shape:
@@ -0,0 +1,66 @@
+import numpy as np
+import torch
+
+from models import vectors
+
+# Largest absolute difference allowed between the eager and exported outputs
+PARITY_TOLERANCE = 1e-5
+
+PARITY_BATCHES = 8
+
+class ServingProjector(torch.nn.Module):
+    """
+    The part of a query or doc projector that gets exported, without the shape checks or packing of the eager model.
+
+    Rather than packing, the LSTM runs over the whole padded batch and each row's output is taken at its last
+    real token. For a single layer, single direction LSTM that is the same as the final hidden state of the packed
+    sequence, since padding only comes after it. Word vectors are an input rather than part of the graph, so the
+    exported file only holds the trained layers and serving keeps using the shared memory mapped vectors.
+    """
+    def __init__(self, projector: torch.nn.Module):
+        super(ServingProjector, self).__init__()
+        self.rnn = projector.rnn
+        self.project = projector.project
+
+    def forward(self, ids: torch.Tensor, lengths: torch.Tensor, word_vectors: torch.Tensor) -> torch.Tensor:
+        embeddings = torch.nn.functional.embedding(ids, word_vectors)
+        outputs, _ = self.rnn(embeddings)
+        rows = torch.arange(ids.shape[0], device=ids.device)
+        return self.project(outputs[rows, lengths.to(ids.device) - 1])
+
+class ExportedProjector:
+    """Wraps a loaded graph so it's called like the eager projectors, with a padded batch of token ids and their lengths."""
+    def __init__(self, graph: torch.jit.ScriptModule, word_vectors: torch.Tensor):
+        self.graph = graph
+        self.word_vectors = word_vectors
+
+    def __call__(self, ids: torch.Tensor, lengths: torch.Tensor) -> tuple:
+        return self.graph(ids, lengths, self.word_vectors), None
+
+def export(projector: torch.nn.Module) -> torch.jit.ScriptModule:
+    """Script and freeze projector (which should be on the cpu in eval mode, with its weights loaded) into a standalone graph."""
+    graph = torch.jit.script(ServingProjector(projector).eval())
+    # Inlines the weights as constants and folds away anything only needed for training
+    return torch.jit.freeze(graph)
+
+def check_parity(projector: torch.nn.Module, graph: torch.jit.ScriptModule, max_len: int = 60, batch_size: int = 16) -> float:
+    """Compare the eager projector and its exported graph over random batches, raising if they disagree."""
+    rng = np.random.default_rng(16)
+    word_vectors = vectors.get_vecs().as_tensor()
+    vocab_size = len(word_vectors)
+
+    max_difference = 0.0
+    with torch.inference_mode():
+        for _ in range(PARITY_BATCHES):
+            lengths = torch.from_numpy(rng.integers(1, max_len + 1, size=batch_size))
+            ids = torch.full((batch_size, int(lengths.max())), vectors.UNK_ID, dtype=torch.int64)
+            for row, length in enumerate(lengths.tolist()):
+                ids[row, :length] = torch.from_numpy(rng.integers(0, vocab_size, size=length))
+
+            expected, _ = projector(ids, lengths)
+            actual = graph(ids, lengths, word_vectors)
+            max_difference = max(max_difference, float((expected - actual).abs().max()))
+
+    if max_difference > PARITY_TOLERANCE:
+        raise ValueError(f"Exported graph differs from the eager model by up to {max_difference}, more than the allowed {PARITY_TOLERANCE}")
+    return max_difference
@@ -1,13 +1,14 @@
 import nltk
-import numpy as np
 from models import vectors
 
 nltk.download('punkt_tab')
 
 EMBEDDING_DIM = vectors.EMBEDDING_DIM
 
-def get_embeddings_for_query(query: str) -> list:
+def get_tokens_for_query(query: str) -> list:
+    return nltk.word_tokenize(query)
+
+def get_ids_for_query(query: str) -> list:
     word_vectors = vectors.get_vecs()
-    tokens = nltk.word_tokenize(query)
-    embeddings = [word_vectors[token] if token in word_vectors else word_vectors['<UNK>'] for token in tokens]
-    return embeddings
+    tokens = get_tokens_for_query(query)
+    return word_vectors.get_ids(tokens)
@@ -1,30 +1,177 @@
-import gensim.downloader
+import fcntl
+import hashlib
+import json
+import os
+import warnings
 import numpy as np
-import random
+import torch
 
-from util import mini
+from util import atomic, mini, constants
 
 word_vectors = None
 
 EMBEDDING_DIM = 300
 
-def get_random_vec():
-    return np.float32(np.random.random(size=EMBEDDING_DIM))
+UNK_TOKEN = '<UNK>'
 
-def get_vecs():
+UNK_ID = 0
+
+SOURCE_MODEL = 'word2vec-google-news-300'
+
+# Rows copied from the source model per write when building the on-disk store
+BUILD_CHUNK_SIZE = 100000
+
+def get_random_vec(rng=np.random):
+    return np.float32(rng.random(size=EMBEDDING_DIM))
+
+class WordVectors:
+    """
+    Read only token -> vector lookup over a single (vocab size x EMBEDDING_DIM) float32 matrix.
+
+    Row 0 is always <UNK>. The matrix is usually a read only memory map, so every process using
+    the same store shares its pages through the OS page cache instead of holding its own copy.
+    """
+    def __init__(self, vocab: list, matrix: np.ndarray):
+        if vocab[0] != UNK_TOKEN:
+            raise ValueError(f"Expected first vocab entry to be {UNK_TOKEN}, got {vocab[0]}")
+        self.vocab = vocab
+        self.index = {token: i for i, token in enumerate(vocab)}
+        self.matrix = matrix
+        self._fingerprint = None
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def __contains__(self, token: str):
+        return token in self.index
+
+    def __getitem__(self, token: str) -> np.ndarray:
+        # asarray gives a plain ndarray view of the memmap row, no copy
+        return np.asarray(self.matrix[self.index[token]])
+
+    def fingerprint(self) -> str:
+        # Identifies the vocab, anything cached as token ids is only valid for the same fingerprint
+        if self._fingerprint is None:
+            self._fingerprint = hashlib.blake2b('\n'.join(self.vocab).encode('utf-8'), digest_size=8).hexdigest()
+        return self._fingerprint
+
+    def get_ids(self, tokens: list) -> list:
+        return [self.index.get(token, UNK_ID) for token in tokens]
+
+    def as_tensor(self) -> torch.Tensor:
+        with warnings.catch_warnings():
+            # The matrix is a read only memmap, torch warns since it can't guarantee we won't write to it. We don't.
+            warnings.simplefilter('ignore', UserWarning)
+            return torch.from_numpy(np.asarray(self.matrix))
+
+# Word vectors copied to each device other than the cpu, shared by every model on that device
+device_tensors = {}
+
+def get_tensor(device: torch.device) -> torch.Tensor:
+    """The word vectors as a tensor on device. On the cpu this is the memory map itself, elsewhere a single copy per device."""
+    # Normalised, so eg. cuda and cuda:0 share a copy
+    device = torch.empty(0, device=device).device
+    if device.type == 'cpu':
+        return get_vecs().as_tensor()
+    if device not in device_tensors:
+        device_tensors[device] = get_vecs().as_tensor().to(device)
+    return device_tensors[device]
+
+class WordVectorsModule(torch.nn.Module):
+    """
+    Base for models which look up token ids in the word vectors, held in a word_vectors buffer.
+
+    The buffer isn't persistent, so weights files only hold the trained layers. Moving the model to another device
+    swaps in the shared copy for that device, rather than every model (eg. both towers) uploading its own copy of the vocab.
+    """
+    def __init__(self):
+        super().__init__()
+        self.register_buffer('word_vectors', get_tensor(torch.device('cpu')), persistent=False)
+
+    def _apply(self, fn, recurse=True):
+        word_vectors = self._buffers.pop('word_vectors')
+        try:
+            super()._apply(fn, recurse)
+        finally:
+            self._buffers['word_vectors'] = word_vectors
+        # fn applied to an empty tensor shows which device the model was moved to
+        self._buffers['word_vectors'] = get_tensor(fn(torch.empty(0)).device)
+        return self
+
+def save(path: str, vocab: list, rows):
+    """Write a vector store to path. rows yields float32 matrices covering vocab in order."""
+    # If another process finishes building first, theirs is kept
+    with atomic.writing(path, directory=True) as tmp_path:
+        matrix = np.lib.format.open_memmap(os.path.join(tmp_path, 'vectors.npy'), mode='w+', dtype=np.float32, shape=(len(vocab), EMBEDDING_DIM))
+        written = 0
+        for chunk in rows:
+            matrix[written:written + len(chunk)] = chunk
+            written += len(chunk)
+        if written != len(vocab):
+            raise ValueError(f"Expected {len(vocab)} vectors, got {written}")
+        matrix.flush()
+        del matrix
+
+        with open(os.path.join(tmp_path, 'vocab.json'), 'w') as f:
+            json.dump(vocab, f)
+
+def load(path: str) -> WordVectors:
+    with open(os.path.join(path, 'vocab.json')) as f:
+        vocab = json.load(f)
+    matrix = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+    return WordVectors(vocab, matrix)
+
+def build(path: str = constants.VECTORS_PATH, keep_tokens: set = None):
+    """
+    Convert the gensim source model into the on-disk store format.
+
+    If keep_tokens is given the vocab is trimmed to those tokens, which shrinks the store to
+    what our corpus and queries actually use.
+    """
+    import gensim.downloader
+
+    print("Downloading word vectors...")
+    source = gensim.downloader.load(SOURCE_MODEL)
+    print("Done")
+
+    source_tokens = source.index_to_key
+    if keep_tokens is not None:
+        source_rows = np.array([i for i, token in enumerate(source_tokens) if token in keep_tokens], dtype=np.int64)
+    else:
+        source_rows = np.arange(len(source_tokens), dtype=np.int64)
+
+    vocab = [UNK_TOKEN] + [source_tokens[i] for i in source_rows if source_tokens[i] != UNK_TOKEN]
+    source_rows = np.array([i for i in source_rows if source_tokens[i] != UNK_TOKEN], dtype=np.int64)
+
+    def rows():
+        # Fixed seed so <UNK> is the same vector everywhere the store is built
+        yield get_random_vec(np.random.default_rng(16)).reshape(1, EMBEDDING_DIM)
+        for start in range(0, len(source_rows), BUILD_CHUNK_SIZE):
+            yield source.vectors[source_rows[start:start + BUILD_CHUNK_SIZE]].astype(np.float32)
+
+    print(f"Writing {len(vocab)} word vectors to {path}...")
+    save(path, vocab, rows())
+    print("Done")
+
+def get_quick_vecs() -> WordVectors:
+    rng = np.random.default_rng(16)
+    vocab = [UNK_TOKEN, 'the', 'a']
+    return WordVectors(vocab, np.stack([get_random_vec(rng) for _ in vocab]))
+
+def get_vecs() -> WordVectors:
     global word_vectors
 
-    if mini.is_quick_vecs():
-        word_vectors = {
-            'the': get_random_vec(),
-            'a': get_random_vec()
-        }
-        word_vectors["<UNK>"] = get_random_vec()
-        return word_vectors
-
-    if not word_vectors:
-        print("Downloading word vectors...")
-        word_vectors = gensim.downloader.load('word2vec-google-news-300')
-        word_vectors["<UNK>"] = get_random_vec()
-        print("Done")
+    if word_vectors is None:
+        if mini.QUICK_VECS:
+            word_vectors = get_quick_vecs()
+            return word_vectors
+
+        if not os.path.exists(os.path.join(constants.VECTORS_PATH, 'vocab.json')):
+            # Processes starting together (eg. the server and caching) build once between them rather than each downloading
+            with open(f"{constants.VECTORS_PATH}.lock", 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if not os.path.exists(os.path.join(constants.VECTORS_PATH, 'vocab.json')):
+                    print("No prebuilt word vectors found, building them now (run `pdm run vecs` to do this ahead of time)")
+                    build()
+        word_vectors = load(constants.VECTORS_PATH)
     return word_vectors
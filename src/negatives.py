@@ -0,0 +1,44 @@
+import numpy as np
+import torch
+
+# Negative doc for each row is drawn from the training data ahead of time and stored in the chunk
+SAMPLED = 'sampled'
+# Negatives are the other relevant docs in the same collated batch, nothing extra is embedded
+IN_BATCH = 'in-batch'
+
+MODES = [SAMPLED, IN_BATCH]
+
+MAX_ATTEMPTS = 100
+
+def sample_negative_rows(query_groups: np.ndarray, doc_groups: np.ndarray, rows: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    """
+    For each row in rows, draw the index of another row whose query and doc both differ from it.
+
+    query_groups and doc_groups hold an integer group per row of the dataset (eg. from pd.factorize), so
+    every draw and clash check is done in bulk over the whole array of rows at once.
+    """
+    negatives = rng.integers(0, len(doc_groups), size=len(rows))
+    for _ in range(MAX_ATTEMPTS):
+        clashes = (query_groups[negatives] == query_groups[rows]) | (doc_groups[negatives] == doc_groups[rows])
+        clash_count = int(clashes.sum())
+        if clash_count == 0:
+            return negatives
+        negatives[clashes] = rng.integers(0, len(doc_groups), size=clash_count)
+    raise ValueError(f"No non-relevant result found for {clash_count} rows in {MAX_ATTEMPTS} random samples. Weird.")
+
+def in_batch_triplet_loss(query_outputs: torch.Tensor, doc_outputs: torch.Tensor, query_groups: torch.Tensor, doc_groups: torch.Tensor, margin: float) -> torch.Tensor:
+    """
+    Triplet loss with cosine distance, using every other relevant doc in the batch as a negative for each query.
+
+    Equivalent to averaging TripletMarginWithDistanceLoss over every valid (query, positive, negative) triplet in the
+    batch. Docs which are the row's own doc, or relevant to the row's query, are masked out.
+    """
+    similarities = torch.nn.functional.normalize(query_outputs, dim=1) @ torch.nn.functional.normalize(doc_outputs, dim=1).T
+    positive_similarities = similarities.diagonal().unsqueeze(1)
+
+    valid = (doc_groups.unsqueeze(0) != doc_groups.unsqueeze(1)) & (query_groups.unsqueeze(0) != query_groups.unsqueeze(1))
+
+    # (1 - positive) - (1 - negative) + margin
+    losses = torch.relu(similarities - positive_similarities + margin)
+
+    return (losses * valid).sum() / valid.sum().clamp(min=1)
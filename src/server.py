@@ -1,19 +1,42 @@
 from fastapi import FastAPI, Request, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from typing import Annotated
+from typing import Annotated, List
+from pydantic import BaseModel, Field
+from contextlib import asynccontextmanager
 import logging
 
-from bin.cache_docs import main as cache_docs
 import inference
-from models import vectors
-from util import chroma
+import batcher
+import startup
+from util import metrics
 
 import os
 dirname = os.path.dirname(__file__)
 
-app = FastAPI()
+server_startup = startup.Startup()
+
+# Log the per stage timings of every search, rather than only those requested with ?trace=true
+TRACE_REQUESTS = int(os.environ.get('TRACE_REQUESTS', '0')) == 1
+
+# Limits for a single /api/search request, bigger jobs should be split across requests (or use `pdm run cli --batch`)
+MAX_API_QUERIES = int(os.environ.get('MAX_API_QUERIES', '1000'))
+MAX_API_K = 100
+
+class SearchRequest(BaseModel):
+    queries: List[str] = Field(min_length=1, max_length=MAX_API_QUERIES)
+    k: int = Field(default=inference.MAX_RESULTS, ge=1, le=MAX_API_K)
+    include_text: bool = True
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Doc indexing runs as a separate job (`pdm run cache`), the server waits for the index during warm-up
+    server_startup.start()
+    yield
+    search_batcher.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 templates = Jinja2Templates(directory=os.path.join(dirname, "web/templates"))
 
@@ -21,17 +44,19 @@ static_dir = os.path.join(dirname, "web/static")
 
 app.mount(static_dir, StaticFiles(directory=static_dir), name="static")
 
-vectors.get_vecs()
+# Concurrent searches are batched together and run off the event loop
+search_batcher = batcher.RequestBatcher(inference.search_batch)
 
-print('Checking if docs have been cached...')
-try:
-    docs = chroma.client.get_collection(name="docs")
-    count = docs.count()
-    print(f"Docs collection already exists, skipping caching. (doc count: {count})")
-except Exception:
-    print('Docs not cached. Storing vectors now.')
-    cache_docs()
-    print('> Done')
+@app.get("/healthz", response_class=JSONResponse)
+async def root(request: Request):
+    # Liveness, only fails if startup can't recover without a restart
+    if server_startup.failed:
+        return JSONResponse(server_startup.status(), status_code=500)
+    return {'status': 'ok'}
+
+@app.get("/readyz", response_class=JSONResponse)
+async def root(request: Request):
+    return JSONResponse(server_startup.status(), status_code=200 if server_startup.ready else 503)
 
 @app.get("/", response_class=HTMLResponse)
 async def root(request: Request):
@@ -44,14 +69,24 @@ async def root(request: Request, query: Annotated[str, Form()]):
     return RedirectResponse(url=f"/results?query={query}", status_code=302)
 
 @app.get("/results", response_class=HTMLResponse)
-async def root(request: Request, query: str):
+async def root(request: Request, query: str, trace: bool = False):
+    if not server_startup.ready:
+        return templates.TemplateResponse(
+            request=request, name="index.j2", context={"query": query, "error": "Still starting up, try again in a moment"}, status_code=503
+        )
     try:
-        results = inference.search(query)
+        request_trace = [] if trace or TRACE_REQUESTS else None
+        results = await search_batcher.submit(query, request_trace)
         for result in results:
             result['summary'] = result['doc_text'].replace("\\r\\n", "")[0:200]
-        return templates.TemplateResponse(
+        response = templates.TemplateResponse(
             request=request, name="index.j2", context={"query": query, "results": results}
         )
+        if request_trace is not None:
+            server_timing = metrics.format_server_timing(request_trace)
+            print(f"TRACE: {query!r}: {server_timing}")
+            response.headers['Server-Timing'] = server_timing
+        return response
     except Exception:
         logging.exception("Query failed")
         return templates.TemplateResponse(
@@ -59,12 +94,49 @@ async def root(request: Request, query: str):
         )
 
 
+@app.post("/api/search", response_class=JSONResponse)
+async def root(request: Request, search_request: SearchRequest):
+    if not server_startup.ready:
+        return JSONResponse({'error': 'Still starting up, try again in a moment'}, status_code=503)
+    try:
+        # Already a batch, so it skips waiting in the batcher but still runs on its worker threads
+        results = await search_batcher.run_batch(search_request.queries, search_request.k)
+    except Exception:
+        logging.exception("Batch query failed")
+        return JSONResponse({'error': 'Something went wrong'}, status_code=500)
+
+    responses = []
+    for query, query_results in zip(search_request.queries, results):
+        if isinstance(query_results, Exception):
+            # Only this query failed, the rest of the batch still gets results
+            logging.error("Query in batch failed", exc_info=query_results)
+            responses.append({'query': query, 'error': 'Something went wrong'})
+            continue
+        if not search_request.include_text:
+            query_results = [{'doc_ref': result['doc_ref']} for result in query_results]
+        responses.append({'query': query, 'results': query_results})
+    return {'results': responses}
+
 @app.get("/lucky", response_class=RedirectResponse)
 async def root(request: Request):
     query = inference.get_random_query()
 
     return RedirectResponse(url=f"/results?query={query}", status_code=302)
 
+@app.get("/cache-stats", response_class=JSONResponse)
+async def root(request: Request):
+    return inference.get_cache_stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def root(request: Request):
+    cache_lines = []
+    for stat, metric_type in [('hits', 'counter'), ('misses', 'counter'), ('size', 'gauge')]:
+        name = f"{metrics.PREFIX}_cache_{stat}" + ('_total' if metric_type == 'counter' else '')
+        cache_lines.append(f"# TYPE {name} {metric_type}")
+        for cache_name, stats in inference.get_cache_stats().items():
+            cache_lines.append(f"{name}{{cache=\"{cache_name}\"}} {stats[stat]}")
+    return metrics.render_prometheus(cache_lines)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8080)
@@ -0,0 +1,80 @@
+import logging
+import threading
+import time
+
+import inference
+from models import vectors
+
+# Run once everything is loaded so the first real request doesn't pay for lazy initialisation
+WARMUP_QUERIES = [
+    'what is the capital of france',
+    'how long does it take to boil an egg',
+    'symptoms of the flu'
+]
+
+# How often to check for the doc index while the indexing job is still building it
+INDEX_POLL_SECONDS = 5
+
+class Startup:
+    """
+    Loads everything search needs on a background thread, so the server accepts connections (and
+    answers liveness checks) straight away and only reports ready once searches will be fast.
+    """
+    def __init__(self):
+        self.stage = 'starting'
+        self.ready = False
+        self.failed = False
+        self.started_at = time.monotonic()
+        self.ready_after_seconds = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='startup', daemon=True)
+        self.thread.start()
+
+    def _set_stage(self, stage: str):
+        print(f"Startup: {stage}...")
+        self.stage = stage
+
+    def _wait_for_index(self):
+        while True:
+            try:
+                count = inference.get_doc_index().count()
+                print(f"Doc index found (doc count: {count})")
+                return
+            except Exception:
+                print(f"Doc index not available yet, checking again in {INDEX_POLL_SECONDS}s (is the indexing job running?)")
+                time.sleep(INDEX_POLL_SECONDS)
+
+    def _run(self):
+        try:
+            self._set_stage('loading word vectors')
+            vectors.get_vecs()
+
+            # The indexer job ingests the docs before building the index, so the doc store can only be loaded after
+            self._set_stage('waiting for doc index')
+            self._wait_for_index()
+
+            self._set_stage('loading query projector and doc store')
+            inference.load_model_and_docs()
+
+            self._set_stage('running warm-up queries')
+            inference.search_batch(WARMUP_QUERIES)
+            inference.get_random_query()
+
+            self.ready_after_seconds = round(time.monotonic() - self.started_at, 3)
+            self.stage = 'ready'
+            self.ready = True
+            print(f"Startup: ready after {self.ready_after_seconds}s")
+        except Exception:
+            logging.exception(f"Startup failed while {self.stage}")
+            self.stage = f"failed while {self.stage}"
+            self.failed = True
+
+    def status(self) -> dict:
+        return {
+            'ready': self.ready,
+            'stage': self.stage,
+            'uptime_seconds': round(time.monotonic() - self.started_at, 3),
+            'ready_after_seconds': self.ready_after_seconds
+        }
@@ -1,12 +1,123 @@
+import fcntl
+import hashlib
+import json
+import shutil
+import tempfile
+import threading
 import torch
-import pandas as pd
 import os
 import wandb
 
-import os
+from util import atomic
+
 dirname = os.path.dirname(__file__)
 
-api = wandb.Api()
+ARTIFACTS_PATH = os.path.join(dirname, '../../artifacts')
+# Downloaded files stored under their sha256, so each version is only downloaded and stored once
+STORE_PATH = os.path.join(ARTIFACTS_PATH, 'store')
+# Maps each ref:version we've downloaded to its files, and each ref to the version latest last resolved to
+MANIFEST_PATH = os.path.join(ARTIFACTS_PATH, 'manifest.json')
+
+# Never contact wandb, resolve latest from the manifest instead
+OFFLINE = int(os.environ.get('ARTIFACTS_OFFLINE', '0')) == 1 or os.environ.get('WANDB_MODE') == 'offline'
+# Seconds to wait on wandb when resolving latest, before falling back to the manifest
+RESOLVE_TIMEOUT = int(os.environ.get('ARTIFACTS_RESOLVE_TIMEOUT', '10'))
+
+HASH_CHUNK_SIZE = 1 << 20
+
+api = None
+
+def get_api() -> wandb.Api:
+    # Created on first use, so importing this module (or running offline) never touches the network
+    global api
+    if api is None:
+        api = wandb.Api()
+    return api
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_manifest() -> dict:
+    try:
+        with open(MANIFEST_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'versions': {}, 'latest': {}}
+
+def update_manifest(update):
+    """Apply update to the manifest under a lock, so processes downloading at the same time don't lose each other's entries."""
+    os.makedirs(ARTIFACTS_PATH, exist_ok=True)
+    with open(f"{MANIFEST_PATH}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = load_manifest()
+        update(manifest)
+        with atomic.writing(MANIFEST_PATH) as tmp_path, open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+def get_cached_path(ref: str, version: str, file: str):
+    """Path of file from ref:version in the cache, or None if it isn't cached or fails its checksum."""
+    entry = load_manifest()['versions'].get(f"{ref}:{version}", {}).get(file)
+    if entry is None:
+        return None
+    path = os.path.join(STORE_PATH, entry['sha256'])
+    if not os.path.exists(path) or os.path.getsize(path) != entry['size'] or hash_file(path) != entry['sha256']:
+        print(f"WARNING: Cached {file} for {ref}:{version} is missing or corrupt, ignoring it")
+        return None
+    return path
+
+def store_file(ref: str, version: str, file: str, source_path: str) -> str:
+    sha256 = hash_file(source_path)
+    os.makedirs(STORE_PATH, exist_ok=True)
+    path = os.path.join(STORE_PATH, sha256)
+    if not os.path.exists(path):
+        with atomic.writing(path) as tmp_path:
+            shutil.copyfile(source_path, tmp_path)
+
+    def update(manifest: dict):
+        manifest['versions'].setdefault(f"{ref}:{version}", {})[file] = {'sha256': sha256, 'size': os.path.getsize(path)}
+        manifest['latest'][ref] = version
+    update_manifest(update)
+
+    return path
+
+def lookup_latest(ref: str) -> wandb.Artifact:
+    """The wandb artifact latest points to for ref, raising TimeoutError if wandb doesn't answer within RESOLVE_TIMEOUT."""
+    outcome = {}
+    def lookup():
+        try:
+            outcome['artifact'] = get_api().artifact(f"cnimmo16/search/{ref}:latest")
+        except Exception as e:
+            outcome['error'] = e
+    # wandb retries failed requests for a long time, a daemon thread lets startup move on without it (and exit while it hangs)
+    thread = threading.Thread(target=lookup, daemon=True)
+    thread.start()
+    thread.join(RESOLVE_TIMEOUT)
+    if thread.is_alive():
+        raise TimeoutError(f"no answer after {RESOLVE_TIMEOUT}s")
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['artifact']
+
+def resolve_latest(ref: str) -> tuple:
+    """
+    The version latest points to for ref, along with the wandb artifact when it was resolved online.
+
+    Offline, or when wandb can't be reached within RESOLVE_TIMEOUT, latest is whichever version was last downloaded.
+    """
+    cached_version = load_manifest()['latest'].get(ref)
+    if not OFFLINE:
+        try:
+            artifact = lookup_latest(ref)
+            return artifact.version, artifact
+        except Exception as e:
+            print(f"WARNING: Couldn't resolve {ref}:latest from wandb ({e}), falling back to the local artifact cache")
+    if cached_version is None:
+        raise FileNotFoundError(f"No cached version of {ref}, run once online to download it or set {ref.upper().replace('-', '_')}_PATH")
+    return cached_version, None
 
 def download_from_wandb(ref: str, file: str):
     env_override = os.environ.get(f"{ref.upper().replace('-', '_')}_PATH", None)
@@ -14,14 +125,33 @@ def download_from_wandb(ref: str, file: str):
         print(f"INFO: Using override for {ref}: {env_override}")
         return env_override
 
-    artifact = api.artifact(f"cnimmo16/search/{ref}:latest")
-    dir = artifact.download(os.path.join(dirname, '../../artifacts'))
-    return os.path.join(dir, file)
-    
-def load_artifact(ref: str, type: str):
+    version, artifact = resolve_latest(ref)
+
+    cached_path = get_cached_path(ref, version, file)
+    if cached_path is not None:
+        return cached_path
+
+    if artifact is None:
+        raise FileNotFoundError(f"{ref}:{version} is not in the local artifact cache and wandb can't be reached")
+
+    print(f"Downloading {ref}:{version}...")
+    os.makedirs(ARTIFACTS_PATH, exist_ok=True)
+    download_dir = tempfile.mkdtemp(prefix=f"{ref}-", dir=ARTIFACTS_PATH)
+    try:
+        artifact.download(download_dir)
+        return store_file(ref, version, file, os.path.join(download_dir, file))
+    finally:
+        shutil.rmtree(download_dir, ignore_errors=True)
+
+def load_artifact(ref: str, type: str, map_location: torch.device = torch.device('cpu')):
     if (type == 'model'):
         weights_path = download_from_wandb(ref, f"{ref}.generated.pt")
-        return torch.load(weights_path, map_location=torch.device('cpu'))
+        # Memory mapped, tensors are paged in from the cached file rather than read into memory up front
+        return torch.load(weights_path, map_location=map_location, mmap=True)
+    if (type == 'graph'):
+        graph_path = download_from_wandb(ref, f"{ref}.generated.pt")
+        # Frozen graphs hold their weights as constants, which only map_location can move to another device
+        return torch.jit.load(graph_path, map_location=map_location)
 
     raise Exception(f'Unknown artifact: {ref}')
 
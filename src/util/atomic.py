@@ -0,0 +1,41 @@
+import os
+import shutil
+from contextlib import contextmanager
+
+def _remove(path: str):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+@contextmanager
+def writing(path: str, directory: bool = False):
+    """
+    Yields a temporary path to write in place of path, which replaces path once the block completes, so readers
+    never see a partial write. If the block raises, the temporary path is removed and path is left as it was.
+
+    With directory=True the temporary path is created as an empty directory. A directory can't replace another in
+    one rename, so the old one is removed first, and if another process renames its own into place in between,
+    theirs is kept.
+    """
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    _remove(tmp_path)
+    if directory:
+        os.makedirs(tmp_path)
+    try:
+        yield tmp_path
+    except BaseException:
+        _remove(tmp_path)
+        raise
+
+    if not directory:
+        os.replace(tmp_path, path)
+        return
+    shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
@@ -0,0 +1,37 @@
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+from util import atomic
+
+def snapshot(state_dict: dict) -> dict:
+    """Copy of a state dict on the cpu, so later optimizer steps don't change what gets saved."""
+    return {key: value.detach().to('cpu', copy=True) for key, value in state_dict.items()}
+
+class AsyncCheckpointWriter:
+    """
+    Saves state dicts on a background thread, so training carries on while checkpoints are written.
+
+    Callers pass a snapshot() of the state dict, which they can keep using as long as they don't modify it. Writes
+    happen one at a time in the order they were requested, each to a temporary file that replaces path once complete.
+    """
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoints')
+        self.pending = []
+
+    def save(self, state_snapshot: dict, path: str):
+        self.pending.append(self.executor.submit(self._write, state_snapshot, path))
+
+    @staticmethod
+    def _write(state_dict: dict, path: str):
+        with atomic.writing(path) as tmp_path:
+            torch.save(state_dict, tmp_path)
+
+    def wait(self):
+        """Block until every requested checkpoint is written, raising if any write failed."""
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
@@ -0,0 +1,51 @@
+from contextlib import ExitStack
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from util import atomic
+
+# Rows per parquet row group, the unit chunked readers get back at a time
+ROW_GROUP_SIZE = 50000
+
+class Writer:
+    """
+    Writes a parquet file a DataFrame at a time, each append becoming one or more row groups.
+
+    Writes go to a temporary file which only replaces the real file when closed, so readers never see a partial file.
+    """
+    def __init__(self, path: str, schema: pa.Schema):
+        self.path = path
+        self.target = ExitStack()
+        self.tmp_path = self.target.enter_context(atomic.writing(path))
+        self.schema = schema
+        self.writer = pq.ParquetWriter(self.tmp_path, schema)
+        self.rows = 0
+
+    def append(self, data: pd.DataFrame):
+        self.writer.write_table(pa.Table.from_pandas(data, schema=self.schema, preserve_index=False), row_group_size=ROW_GROUP_SIZE)
+        self.rows += len(data)
+
+    def close(self):
+        self.writer.close()
+        self.target.close()
+
+def write(data: pd.DataFrame, path: str):
+    with atomic.writing(path) as tmp_path:
+        data.to_parquet(tmp_path, index=False, row_group_size=ROW_GROUP_SIZE)
+
+def read(path: str, columns: list = None) -> pd.DataFrame:
+    """Read only the given columns, with the file memory mapped rather than read into a buffer first."""
+    return pq.read_table(path, columns=columns, memory_map=True).to_pandas()
+
+def iter_chunks(path: str, columns: list = None):
+    """Yield the file a row group at a time as DataFrames, so memory is bounded by ROW_GROUP_SIZE rather than the file size."""
+    parquet_file = pq.ParquetFile(path, memory_map=True)
+    for row_group in range(parquet_file.num_row_groups):
+        yield parquet_file.read_row_group(row_group, columns=columns).to_pandas()
+
+def export_csv(path: str, csv_path: str):
+    """Export a parquet file as csv, a row group at a time."""
+    pd.DataFrame(columns=pq.read_schema(path).names).to_csv(csv_path, index=False)
+    for chunk in iter_chunks(path):
+        chunk.to_csv(csv_path, mode='a', header=False, index=False)
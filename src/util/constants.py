@@ -4,6 +4,10 @@ from util import mini
 dirname = os.path.dirname(__file__)
 
 DATA_PATH = os.path.join(dirname, "../../data")
-DOCS_PATH = os.path.join(DATA_PATH, "docs.generated.csv")
-TRAINING_DATA_PATH = os.path.join(DATA_PATH, "training-data.generated.csv")
-SAMPLE_QUERIES_PATH = os.path.join(DATA_PATH, "sample-queries.generated.csv")
+DOCS_PATH = os.path.join(DATA_PATH, "docs.generated.parquet")
+TRAINING_DATA_PATH = os.path.join(DATA_PATH, "training-data.generated.parquet")
+SAMPLE_QUERIES_PATH = os.path.join(DATA_PATH, "sample-queries.generated.parquet")
+DOC_STORE_PATH = os.path.join(DATA_PATH, "doc-store.generated")
+VECTORS_PATH = os.path.join(DATA_PATH, "word-vectors.generated")
+INDEX_VERSION_PATH = os.path.join(DATA_PATH, "index-version.generated.txt")
+INDEXING_STATE_PATH = os.path.join(DATA_PATH, "indexing-state.generated.json")
@@ -3,7 +3,7 @@ from util import mini
 
 def get_device():
     if torch.cuda.is_available():
-        if mini.is_mini():
+        if mini.MINI:
             raise Exception("Did not expect mini mode when CUDA is available")
         return torch.device('cuda')
     if torch.mps.is_available():
@@ -0,0 +1,89 @@
+import datetime
+import os
+import socket
+from contextlib import ExitStack
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+# Data parallel training processes, either launched by train itself (TRAIN_PROCESSES) or by torchrun (WORLD_SIZE)
+WORLD_SIZE = int(os.environ.get('WORLD_SIZE', os.environ.get('TRAIN_PROCESSES', '1')))
+# gloo runs on plain cpus, nccl is only worth it with a gpu per process
+BACKEND = os.environ.get('DIST_BACKEND', 'gloo')
+# How long processes wait on each other, long enough for rank 0 to prepare every training chunk while the others wait
+TIMEOUT = datetime.timedelta(minutes=int(os.environ.get('DIST_TIMEOUT_MINUTES', '120')))
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main() -> bool:
+    return get_rank() == 0
+
+def _get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _join(fn, args: tuple):
+    dist.init_process_group(BACKEND, timeout=TIMEOUT)
+    # Split the cores between the processes, rather than every process starting a thread per core
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // dist.get_world_size()))
+    try:
+        fn(*args)
+    finally:
+        dist.destroy_process_group()
+
+def _spawned(rank: int, world_size: int, port: int, fn, args: tuple):
+    os.environ.update({'MASTER_ADDR': '127.0.0.1', 'MASTER_PORT': str(port), 'RANK': str(rank), 'WORLD_SIZE': str(world_size)})
+    _join(fn, args)
+
+def launch(fn, world_size: int = WORLD_SIZE, args: tuple = ()):
+    """
+    Run fn(*args) in each of world_size processes joined in a process group.
+
+    With a world size of 1 fn runs in this process without a process group. Under torchrun, which has already
+    started a process per rank, fn runs in this process after joining the group.
+    """
+    if world_size == 1:
+        fn(*args)
+    elif 'RANK' in os.environ:
+        _join(fn, args)
+    else:
+        # fn and args must be picklable, each process imports fn's module afresh
+        mp.spawn(_spawned, args=(world_size, _get_free_port(), fn, args), nprocs=world_size)
+
+def wrap(module: torch.nn.Module) -> torch.nn.Module:
+    """module wrapped to all-reduce its gradients across processes, or module itself when not distributed."""
+    if not is_distributed():
+        return module
+    # DDP broadcasts every buffer from rank 0 when it's constructed, even with broadcast_buffers=False. Every process maps
+    # the same read only word vectors, so broadcasting them would write into the mmap (and copy the whole vocab). There is
+    # no public option to leave a single buffer out, so this uses DDP's private, but long standing, ignore list
+    torch.nn.parallel.DistributedDataParallel._set_params_and_buffers_to_ignore_for_model(module, [name for name, _ in module.named_buffers() if name.endswith('word_vectors')])
+    return torch.nn.parallel.DistributedDataParallel(module, broadcast_buffers=False)
+
+def no_sync(*modules):
+    """Skip the gradient all-reduce for the next backward pass of every wrapped module, eg. for all but the last accumulated batch."""
+    stack = ExitStack()
+    for module in modules:
+        if isinstance(module, torch.nn.parallel.DistributedDataParallel):
+            stack.enter_context(module.no_sync())
+    return stack
+
+def all_reduce_sum(values: list) -> list:
+    """Element-wise sum of values across all processes."""
+    if not is_distributed():
+        return values
+    tensor = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return tensor.tolist()
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import mmap
+import os
+import numpy as np
+
+from util import atomic, constants, columnar
+
+EMPTY_SLOT = -1
+
+def _hash_ref(doc_ref: str) -> int:
+    # Stable across processes, unlike python's built in hash()
+    return int.from_bytes(hashlib.blake2b(doc_ref.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def _source_signature(source_path: str) -> dict:
+    stat = os.stat(source_path)
+    return {'source_size': stat.st_size, 'source_mtime': stat.st_mtime}
+
+def _mmap_file(path: str):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+class DocStore:
+    """
+    Read only doc_ref -> doc_text lookup backed by files on disk.
+
+    Texts and refs are stored as concatenated utf-8 blobs with offset indexes, and doc_refs are found
+    through an open addressing hash table, so a lookup is O(1) and only touches the pages it needs.
+    Everything is memory mapped, so multiple worker processes share the same pages via the OS page cache.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.texts = _mmap_file(os.path.join(path, 'texts.bin'))
+        self.refs = _mmap_file(os.path.join(path, 'refs.bin'))
+        self.text_offsets = np.load(os.path.join(path, 'text_offsets.npy'), mmap_mode='r')
+        self.ref_offsets = np.load(os.path.join(path, 'ref_offsets.npy'), mmap_mode='r')
+        self.slots = np.load(os.path.join(path, 'slots.npy'), mmap_mode='r')
+        self.slot_hashes = np.load(os.path.join(path, 'slot_hashes.npy'), mmap_mode='r')
+        self.capacity = len(self.slots)
+
+    def __len__(self):
+        return self.meta['count']
+
+    def __contains__(self, doc_ref: str):
+        return self._find_row(doc_ref) is not None
+
+    def _ref_at(self, row: int) -> str:
+        return self.refs[self.ref_offsets[row]:self.ref_offsets[row + 1]].decode('utf-8')
+
+    def _text_at(self, row: int) -> str:
+        return self.texts[self.text_offsets[row]:self.text_offsets[row + 1]].decode('utf-8')
+
+    def _find_row(self, doc_ref: str):
+        if self.capacity == 0:
+            return None
+        ref_hash = _hash_ref(doc_ref)
+        slot = ref_hash % self.capacity
+        while True:
+            row = int(self.slots[slot])
+            if row == EMPTY_SLOT:
+                return None
+            if int(self.slot_hashes[slot]) == ref_hash and self._ref_at(row) == doc_ref:
+                return row
+            slot = (slot + 1) % self.capacity
+
+    def get(self, doc_ref: str):
+        row = self._find_row(doc_ref)
+        if row is None:
+            return None
+        return {'doc_ref': doc_ref, 'doc_text': self._text_at(row)}
+
+    def __getitem__(self, doc_ref: str) -> dict:
+        doc = self.get(doc_ref)
+        if doc is None:
+            raise KeyError(doc_ref)
+        return doc
+
+def build(source_path: str = constants.DOCS_PATH, path: str = constants.DOC_STORE_PATH):
+    print('Building doc store...')
+
+    # If another process finishes building first, theirs is just as good
+    with atomic.writing(path, directory=True) as tmp_path:
+        text_offsets = [0]
+        ref_offsets = [0]
+        hashes = []
+        with open(os.path.join(tmp_path, 'texts.bin'), 'wb') as texts_file, open(os.path.join(tmp_path, 'refs.bin'), 'wb') as refs_file:
+            # A row group at a time keeps build memory bounded
+            for chunk in columnar.iter_chunks(source_path, ['doc_ref', 'doc_text']):
+                for doc_ref, doc_text in zip(chunk['doc_ref'].astype(str), chunk['doc_text'].astype(str)):
+                    encoded_ref = doc_ref.encode('utf-8')
+                    encoded_text = doc_text.encode('utf-8')
+                    refs_file.write(encoded_ref)
+                    texts_file.write(encoded_text)
+                    ref_offsets.append(ref_offsets[-1] + len(encoded_ref))
+                    text_offsets.append(text_offsets[-1] + len(encoded_text))
+                    hashes.append(_hash_ref(doc_ref))
+
+        ref_offsets = np.array(ref_offsets, dtype=np.int64)
+        text_offsets = np.array(text_offsets, dtype=np.int64)
+
+        # Power of two at least twice the row count keeps probe chains short
+        capacity = 1 << max(1, (2 * len(hashes) - 1).bit_length()) if hashes else 0
+        slots = np.full(capacity, EMPTY_SLOT, dtype=np.int64)
+        slot_hashes = np.zeros(capacity, dtype=np.uint64)
+
+        count = 0
+        with open(os.path.join(tmp_path, 'refs.bin'), 'rb') as refs_file:
+            refs = refs_file.read()
+        for row, ref_hash in enumerate(hashes):
+            slot = ref_hash % capacity
+            duplicate = False
+            while slots[slot] != EMPTY_SLOT:
+                existing = slots[slot]
+                if int(slot_hashes[slot]) == ref_hash and refs[ref_offsets[existing]:ref_offsets[existing + 1]] == refs[ref_offsets[row]:ref_offsets[row + 1]]:
+                    # Keep the first occurrence of a doc_ref, matching drop_duplicates
+                    duplicate = True
+                    break
+                slot = (slot + 1) % capacity
+            if not duplicate:
+                slots[slot] = row
+                slot_hashes[slot] = ref_hash
+                count += 1
+
+        np.save(os.path.join(tmp_path, 'text_offsets.npy'), text_offsets)
+        np.save(os.path.join(tmp_path, 'ref_offsets.npy'), ref_offsets)
+        np.save(os.path.join(tmp_path, 'slots.npy'), slots)
+        np.save(os.path.join(tmp_path, 'slot_hashes.npy'), slot_hashes)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'count': count, **_source_signature(source_path)}, f)
+
+    print(f"> Done (doc count: {count})")
+
+def _is_stale(source_path: str, path: str) -> bool:
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return True
+    if not os.path.exists(source_path):
+        return False
+    signature = _source_signature(source_path)
+    return meta['source_size'] != signature['source_size'] or meta['source_mtime'] != signature['source_mtime']
+
+def load(source_path: str = constants.DOCS_PATH, path: str = constants.DOC_STORE_PATH) -> DocStore:
+    if _is_stale(source_path, path):
+        build(source_path, path)
+    return DocStore(path)
@@ -0,0 +1,90 @@
+import hashlib
+import os
+
+from util import atomic, constants
+
+JOURNALS_PATH = os.path.join(constants.DATA_PATH, 'index-journals')
+
+DELETED = '-'
+
+def hash_doc(doc_text: str) -> str:
+    return hashlib.blake2b(doc_text.encode('utf-8'), digest_size=16).hexdigest()
+
+def get_journal_path(index_name: str) -> str:
+    return os.path.join(JOURNALS_PATH, f"{index_name}.generated.tsv")
+
+class IndexJournal:
+    """
+    Append only record of which version of each doc is stored in a vector index.
+
+    The first line holds the fingerprint of the model the vectors were encoded with, then every line is
+    `doc_ref<TAB>content hash` for a doc written to the index, or `doc_ref<TAB>-` for a doc removed from it.
+    Lines are appended (and flushed) straight after each batch is written to the index, so replaying the
+    journal after a crash tells us exactly what still needs encoding.
+    """
+    def __init__(self, index_name: str):
+        self.index_name = index_name
+        self.path = get_journal_path(index_name)
+        self.model_fingerprint = None
+        self.hashes = {}
+        if os.path.exists(self.path):
+            self._replay()
+
+    def _replay(self):
+        with open(self.path) as f:
+            header = f.readline().rstrip('\n')
+            self.model_fingerprint = header.split(' ', 1)[1] if header.startswith('# ') else None
+            for line in f:
+                if not line.endswith('\n'):
+                    # Torn final line from an interrupted write
+                    break
+                doc_ref, doc_hash = line.rstrip('\n').split('\t')
+                if doc_hash == DELETED:
+                    self.hashes.pop(doc_ref, None)
+                else:
+                    self.hashes[doc_ref] = doc_hash
+
+    def exists(self) -> bool:
+        return self.model_fingerprint is not None
+
+    def start(self, model_fingerprint: str):
+        """Start an empty journal for a freshly created index."""
+        os.makedirs(JOURNALS_PATH, exist_ok=True)
+        self.model_fingerprint = model_fingerprint
+        self.hashes = {}
+        with open(self.path, 'w') as f:
+            f.write(f"# {model_fingerprint}\n")
+
+    def _append(self, entries: list):
+        with open(self.path, 'a') as f:
+            f.write(''.join(f"{doc_ref}\t{doc_hash}\n" for doc_ref, doc_hash in entries))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def record_added(self, doc_refs: list, doc_hashes: list):
+        self._append(zip(doc_refs, doc_hashes))
+        self.hashes.update(zip(doc_refs, doc_hashes))
+
+    def record_deleted(self, doc_refs: list):
+        self._append((doc_ref, DELETED) for doc_ref in doc_refs)
+        for doc_ref in doc_refs:
+            self.hashes.pop(doc_ref, None)
+
+    def compact(self):
+        """Rewrite the journal as one line per doc currently in the index."""
+        with atomic.writing(self.path) as tmp_path, open(tmp_path, 'w') as f:
+            f.write(f"# {self.model_fingerprint}\n")
+            f.write(''.join(f"{doc_ref}\t{doc_hash}\n" for doc_ref, doc_hash in self.hashes.items()))
+
+    def move_to(self, index_name: str):
+        """Follow the index when it's swapped in under another name."""
+        path = get_journal_path(index_name)
+        os.replace(self.path, path)
+        self.index_name = index_name
+        self.path = path
+
+def delete_journal(index_name: str):
+    try:
+        os.remove(get_journal_path(index_name))
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,118 @@
+import bisect
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+
+ENABLED = int(os.environ.get('METRICS', '1')) == 1
+
+# Upper bounds in seconds, roughly the prometheus client defaults with more resolution under 10ms
+BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+PREFIX = 'finditperhaps'
+
+class Histogram:
+    def __init__(self, buckets: list = BUCKETS):
+        self.buckets = buckets
+        # Last slot counts observations above every bucket (+Inf)
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[bucket] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Approximate quantile, the upper bound of the bucket it falls in."""
+        with self.lock:
+            target = q * self.count
+            seen = 0
+            for bound, count in zip(self.buckets + [float('inf')], self.counts):
+                seen += count
+                if seen >= target and seen > 0:
+                    return bound
+        return 0.0
+
+stage_histograms = {}
+stage_histograms_lock = threading.Lock()
+
+# Set while a traced piece of work runs, timed() then also records each stage in it
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+def get_histogram(stage: str) -> Histogram:
+    histogram = stage_histograms.get(stage)
+    if histogram is None:
+        with stage_histograms_lock:
+            histogram = stage_histograms.setdefault(stage, Histogram())
+    return histogram
+
+def observe(stage: str, seconds: float):
+    if ENABLED:
+        get_histogram(stage).observe(seconds)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.append((stage, seconds))
+
+@contextmanager
+def timed(stage: str):
+    if not ENABLED and current_trace.get() is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+def traced(fn, *args):
+    """Run fn, returning its result along with the (stage, seconds) timings recorded while it ran."""
+    trace = []
+    token = current_trace.set(trace)
+    try:
+        return fn(*args), trace
+    finally:
+        current_trace.reset(token)
+
+def get_percentiles(timings: list) -> dict:
+    """Exact p50, p90 and p99 in milliseconds of a list of timings in seconds, for benchmarks and reports."""
+    timings_ms = np.array(timings) * 1000
+    return {
+        'p50_ms': float(np.percentile(timings_ms, 50)),
+        'p90_ms': float(np.percentile(timings_ms, 90)),
+        'p99_ms': float(np.percentile(timings_ms, 99))
+    }
+
+def format_server_timing(trace: list) -> str:
+    """Format a trace as a Server-Timing header value, shown per request in browser dev tools."""
+    return ', '.join(f"{stage.replace('.', '-')};dur={seconds * 1000:.3f}" for stage, seconds in trace)
+
+def render_prometheus(extra_lines: list = None) -> str:
+    name = f"{PREFIX}_stage_duration_seconds"
+    lines = [
+        f"# HELP {name} Time spent in each stage of search and doc encoding.",
+        f"# TYPE {name} histogram"
+    ]
+    for stage, histogram in sorted(stage_histograms.items()):
+        with histogram.lock:
+            counts = list(histogram.counts)
+            total, count = histogram.sum, histogram.count
+        cumulative = 0
+        for bound, bucket_count in zip(histogram.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{{stage=\"{stage}\",le=\"{bound}\"}} {cumulative}")
+        lines.append(f"{name}_bucket{{stage=\"{stage}\",le=\"+Inf\"}} {count}")
+        lines.append(f"{name}_sum{{stage=\"{stage}\"}} {total}")
+        lines.append(f"{name}_count{{stage=\"{stage}\"}} {count}")
+    return '\n'.join(lines + (extra_lines or [])) + '\n'
+
+def print_summary():
+    for stage, histogram in sorted(stage_histograms.items()):
+        mean_ms = histogram.sum / histogram.count * 1000 if histogram.count else 0.0
+        print(f"{stage}: count {histogram.count}, total {histogram.sum:.2f}s, mean {mean_ms:.3f}ms, p50 <= {histogram.quantile(0.5) * 1000:g}ms, p99 <= {histogram.quantile(0.99) * 1000:g}ms")
@@ -1,7 +1,6 @@
 import os
 
-def is_mini():
-    return int(os.environ.get('FULLRUN', '0')) == 0
-
-def is_quick_vecs():
-    return int(os.environ.get('QUICKVECS', '0')) == 1
+# Run on a small sample of the data, unless FULLRUN=1
+MINI = int(os.environ.get('FULLRUN', '0')) == 0
+# Random stand in word vectors instead of downloading the real ones
+QUICK_VECS = int(os.environ.get('QUICKVECS', '0')) == 1
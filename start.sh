@@ -2,5 +2,6 @@
 
 # only to be run from docker
 
-PYTHONPATH=src FULLRUN=1 python -m bin.load_to_csv
+# Serving only, the server starts straight away and reports ready on /readyz once the indexer job has built the index.
+# Word vectors, the projector and the doc store are loaded in the background by startup.Startup
 PYTHONPATH=src python src/server.py
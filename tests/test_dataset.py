@@ -0,0 +1,31 @@
+import numpy as np
+import torch
+
+import models.vectors
+import dataset
+
+cpu = torch.device('cpu')
+
+def test_pad_batch_ids_round_trip():
+    values = [[5, 6, 7], [8], np.array([9, 10], dtype=np.int32)]
+
+    padded_ids, lengths = dataset.pad_batch_ids(values, cpu)
+
+    assert padded_ids.shape == (3, 3)
+    assert padded_ids.dtype == torch.int64
+    assert lengths.tolist() == [3, 1, 2]
+    assert lengths.device.type == 'cpu'
+    for row, ids in zip(padded_ids.tolist(), values):
+        assert row[:len(ids)] == list(ids)
+        assert row[len(ids):] == [models.vectors.UNK_ID] * (3 - len(ids))
+
+def test_pack_batch_ids_round_trip_with_extras():
+    packed = dataset.pack_batch_ids({'query_ids': [[1, 2], [3]], 'relevant_doc_ids': [[4], [5, 6, 7]]}, {'query_groups': np.array([0, 1])})
+
+    batch = dataset.batch_to_device(packed, cpu)
+
+    assert batch['query_ids'][:, :2].tolist() == [[1, 2], [3, models.vectors.UNK_ID]]
+    assert batch['query_lengths'].tolist() == [2, 1]
+    assert batch['relevant_doc_ids'][1].tolist() == [5, 6, 7]
+    assert batch['relevant_doc_lengths'].tolist() == [1, 3]
+    assert batch['query_groups'].tolist() == [0, 1]